@@ -0,0 +1,224 @@
+"""
+Benchmark of the post-processing on synthetic data (synthetic_data.py) at several scales.
+
+Example:
+    python benchmark.py --scales small medium --repeat 3 --output benchmark_results.json
+    python benchmark.py --scales small --baseline benchmark_results.json
+
+Every scale is generated once under --data-dir and then read, processed and written --repeat times,
+the fastest time of every stage is reported. The numba warm-up run reads the small scale from
+lh5 thread files (--file-extension selects the layout of the timed runs). The event tables are checked against the summaries in
+benchmark_reference.json (sum, min, max and count of every field, the photon counts are random and
+only compared loosely). With --baseline the stage times are compared to an earlier --output file.
+The exit code is 1 if a result differs from the reference or a stage got slower than --max-slowdown.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from processing import convert_to_event_structure, EVENT_FIELDS
+from profiling import profile_run
+from read_and_write import read_data, write_events
+from synthetic_data import write_thread_files, write_optical_map, MAP_RANGES
+from weights import OpticalMap
+
+# threads and events per thread of every scale
+SCALES = {
+    "small": {"threads": 4, "events": 250},
+    "medium": {"threads": 8, "events": 2500},
+    "large": {"threads": 16, "events": 5000},
+}
+
+REFERENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_reference.json")
+
+# emitted_scintillation_photons samples the photon numbers
+STOCHASTIC_FIELDS = ("max_10us_n_photons", "max_10us_n_photons_xenon")
+
+
+def prepare_data(scale, data_dir, seed=0, file_extension="hdf5"):
+    """Generate the thread files and the optical map of a scale unless they already exist"""
+    params = {**SCALES[scale], "seed": seed}
+    run_directory = os.path.join(data_dir, scale if file_extension == "hdf5" else f"{scale}_{file_extension}")
+    map_dir = os.path.join(data_dir, "1d_map")
+    params_path = os.path.join(run_directory, "params.json")
+
+    existing = None
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            existing = json.load(f)
+    if existing != params:
+        print(f"Generating {scale} data: {params['threads']} threads with {params['events']} events each")
+        write_thread_files(run_directory, params["threads"], params["events"], seed=seed,
+                           file_extension=file_extension)
+        with open(params_path, "w") as f:
+            json.dump(params, f)
+    # the map is rewritten if it was generated with other parameters or ranges
+    map_params = {"seed": seed, "ranges": {coord: list(edges) for coord, edges in MAP_RANGES.items()}}
+    map_params_path = os.path.join(map_dir, "params.json")
+    existing_map = None
+    if os.path.exists(map_params_path):
+        with open(map_params_path) as f:
+            existing_map = json.load(f)
+    if existing_map != map_params:
+        write_optical_map(map_dir, seed=seed)
+        with open(map_params_path, "w") as f:
+            json.dump(map_params, f)
+    return run_directory, map_dir
+
+
+def result_summary(events):
+    """Count of finite values, sum, min and max of every field of an EventTable"""
+    summary = {}
+    for name in EVENT_FIELDS:
+        column = np.asarray(events[name], dtype=float)
+        finite = column[np.isfinite(column)]
+        summary[name] = {
+            "count": int(len(finite)),
+            "sum": float(finite.sum()),
+            "min": float(finite.min()) if len(finite) else None,
+            "max": float(finite.max()) if len(finite) else None,
+        }
+    return summary
+
+
+def compare_summaries(summary, reference, rtol=1e-6, stochastic_rtol=0.05):
+    """Return a list of differences between a result summary and its reference"""
+    differences = []
+    for name, expected in reference.items():
+        if name not in summary:
+            differences.append(f"{name}: missing")
+            continue
+        stochastic = name in STOCHASTIC_FIELDS
+        # min/max of random photon numbers fluctuate too much, only count and sum are compared
+        keys = ("count", "sum") if stochastic else ("count", "sum", "min", "max")
+        for key in keys:
+            value, expected_value = summary[name][key], expected[key]
+            if value is None or expected_value is None:
+                equal = value is None and expected_value is None
+            else:
+                equal = np.isclose(value, expected_value, rtol=stochastic_rtol if stochastic else rtol, atol=1e-9)
+            if not equal:
+                differences.append(f"{name} {key}: {value} != reference {expected_value}")
+    return differences
+
+
+def run_once(run_directory, map_dir, threads, output_path, file_extension="hdf5"):
+    with profile_run(os.path.basename(run_directory)) as profiler:
+        data = read_data(run_directory, file_extension=file_extension, nr_of_threads=threads)
+        events = convert_to_event_structure(*data, optical_map=OpticalMap(map_dir))
+        write_events(events, output_path)
+    return events, profiler
+
+
+def benchmark_scale(scale, data_dir, repeat=3, seed=0, file_extension="hdf5"):
+    """Fastest time of every stage over repeat runs and the summary of the event table"""
+    run_directory, map_dir = prepare_data(scale, data_dir, seed, file_extension)
+    output_path = os.path.join(data_dir, f"results_{os.path.basename(run_directory)}.h5")
+
+    stage_seconds = {}
+    total_seconds = []
+    for _ in range(repeat):
+        events, profiler = run_once(run_directory, map_dir, SCALES[scale]["threads"], output_path, file_extension)
+        report = profiler.report()
+        total_seconds.append(report["total_seconds"])
+        for entry in report["stages"]:
+            stage_seconds[entry["stage"]] = min(stage_seconds.get(entry["stage"], np.inf), entry["seconds"])
+
+    return {
+        "scale": scale,
+        "n_events": len(events),
+        "total_seconds": min(total_seconds),
+        "stages": stage_seconds,
+        "summary": result_summary(events),
+    }
+
+
+def compare_times(result, baseline, max_slowdown=1.25, min_seconds=0.01):
+    """Stages (and the total) that got slower than max_slowdown times the baseline, very short stages are ignored"""
+    slower = []
+    pairs = [("total", result["total_seconds"], baseline["total_seconds"])]
+    pairs += [(name, seconds, baseline["stages"].get(name)) for name, seconds in result["stages"].items()]
+    for name, seconds, baseline_seconds in pairs:
+        if baseline_seconds is None or baseline_seconds < min_seconds:
+            continue
+        if seconds > max_slowdown * baseline_seconds:
+            slower.append(f"{name}: {seconds:.3f} s, baseline {baseline_seconds:.3f} s")
+    return slower
+
+
+def print_result(result):
+    print(f"{result['scale']}: {result['n_events']} events in {result['total_seconds']:.3f} s")
+    for name, seconds in result["stages"].items():
+        print(f"    {name:<28}{seconds:>10.3f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the post-processing on synthetic data.")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(SCALES))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scale, the fastest is reported")
+    parser.add_argument("--data-dir", default="benchmark_data", help="directory of the synthetic data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--file-extension", default="hdf5", choices=["hdf5", "lh5"], help="layout of the thread files")
+    parser.add_argument("--reference", default=REFERENCE_FILE, help="json with the reference result summaries")
+    parser.add_argument("--update-reference", action="store_true", help="store the results as new reference")
+    parser.add_argument("--output", default=None, help="write the timings and summaries to this json file")
+    parser.add_argument("--baseline", default=None, help="earlier --output file to compare the timings with")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="allowed time ratio to the baseline")
+    args = parser.parse_args(argv)
+
+    reference = {}
+    if os.path.exists(args.reference):
+        with open(args.reference) as f:
+            reference = json.load(f)
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {result["scale"]: result for result in json.load(f)}
+
+    # the first call compiles the numba kernels, this should not count towards the first scale.
+    # It reads lh5 files, so the lh5 reader is checked against the same reference in every benchmark.
+    warm_up = benchmark_scale("small", args.data_dir, repeat=1, seed=args.seed, file_extension="lh5")
+    failed = False
+    key = f"small_seed{args.seed}"
+    if not args.update_reference and key in reference:
+        for difference in compare_summaries(warm_up["summary"], reference[key]):
+            print(f"    lh5 warm-up differs from reference: {difference}")
+            failed = True
+
+    results = []
+    for scale in args.scales:
+        result = benchmark_scale(scale, args.data_dir, args.repeat, args.seed, args.file_extension)
+        results.append(result)
+        print_result(result)
+
+        key = f"{scale}_seed{args.seed}"
+        if args.update_reference:
+            reference[key] = result["summary"]
+        elif key in reference:
+            differences = compare_summaries(result["summary"], reference[key])
+            for difference in differences:
+                print(f"    differs from reference: {difference}")
+            failed |= bool(differences)
+        else:
+            print(f"    no reference for {key}")
+
+        if scale in baseline:
+            slower = compare_times(result, baseline[scale], args.max_slowdown)
+            for entry in slower:
+                print(f"    slower than baseline: {entry}")
+            failed |= bool(slower)
+
+    if args.update_reference:
+        with open(args.reference, "w") as f:
+            json.dump(reference, f, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import h5py
+
+from read_and_write import write_events, read_events
+
+# Bump this whenever the feature computation in processing.py changes, so old cache entries are not used anymore
+FEATURE_VERSION = 1
+
+
+class FeatureCache:
+    """
+    On-disk cache of the event features of single thread files.
+
+    Every entry is the EventTable of one out_t{i} file stored with write_events. The key combines the
+    path, size and mtime of the thread file with a hash of the feature parameters, so changed outputs or
+    parameters are recomputed and everything else is served from the cache. When the cache grows beyond
+    max_bytes the least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir="feature_cache", max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path, params):
+        """Cache key of a thread file for the given feature parameters (must be json serializable)"""
+        stat = os.stat(file_path)
+        key_data = {
+            "path": os.path.abspath(file_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "params": params,
+            "version": FEATURE_VERSION,
+        }
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.h5")
+
+    def entries(self):
+        """Paths of all cache entries"""
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".h5")
+        ]
+
+    def size(self):
+        """Total size of the cache entries in bytes"""
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def get(self, key):
+        """EventTable of the entry or None. Marks the entry as recently used."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        table = read_events(path, "hdf5", apply_schema=False)
+        os.utime(path)
+        return table
+
+    def put(self, key, table, source=None):
+        """Store an EventTable, source is the thread file it was computed from (for invalidate)"""
+        path = self.path(key)
+        # write to a temporary file first so an interrupted write never leaves a broken entry
+        tmp_path = f"{path}.tmp"
+        write_events(table, tmp_path, "hdf5", apply_schema=False)
+        if source is not None:
+            with h5py.File(tmp_path, "a") as f:
+                f.attrs["source"] = os.path.abspath(source)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def invalidate(self, file_path=None):
+        """Delete the entries of one thread file, or the whole cache if file_path is None"""
+        source = None if file_path is None else os.path.abspath(file_path)
+        for path in self.entries():
+            if source is not None:
+                with h5py.File(path, "r") as f:
+                    if f.attrs.get("source") != source:
+                        continue
+            os.remove(path)
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits into max_bytes"""
+        entries = sorted(self.entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
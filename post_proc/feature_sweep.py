@@ -0,0 +1,214 @@
+"""
+Event features for many window, bin width and threshold choices in one pass.
+
+    cubes = sweep_event_features(scint_data, optical_data,
+                                 light_windows=[(-np.inf, 1e3), (1e3, 5e3), (1e3, 10e3)],
+                                 interval_widths=[100, 200, 400], min_detectors=range(3, 10),
+                                 scintillator_windows_us=[5, 10, 20])
+    cubes["intervals"].select(tmin=1e3, tmax=10e3, width=200, min_detectors=6)["n_intervals"]
+
+The optical hits are reduced once to an OpticalHistogram (or one is passed in), every window edge and
+interval width must be a multiple of its bin width. The scintillator photons are sampled once and
+shared by all window lengths. The default parameters give the features of convert_to_event_structure.
+"""
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from processing import (OpticalHistogram, brightest_window_start, interval_detector_counts, interval_moments,
+                        scintillator_window_inputs, sliding_window_max, SIPM_DET_EFFICIENCY)
+from profiling import stage
+
+
+class FeatureCube:
+    """
+    Features of every event for many parameter sets.
+
+    params: DataFrame with one row per parameter set.
+    values: dict feature name -> array of shape (n_events, n_parameter_sets).
+    """
+
+    def __init__(self, event_id, params, values):
+        self.event_id = np.asarray(event_id)
+        self.params = params.reset_index(drop=True)
+        self.values = values
+
+    def __getitem__(self, feature):
+        return self.values[feature]
+
+    def __len__(self):
+        return len(self.event_id)
+
+    def index(self, **params):
+        """Position of the parameter set with these values"""
+        match = np.ones(len(self.params), dtype=bool)
+        for name, value in params.items():
+            match &= np.isclose(self.params[name].to_numpy(dtype=float), value, rtol=0, atol=1e-9)
+        positions = np.flatnonzero(match)
+        if len(positions) != 1:
+            raise KeyError(f"{len(positions)} parameter sets match {params}.")
+        return positions[0]
+
+    def select(self, **params):
+        """dict feature name -> values per event for one parameter set"""
+        position = self.index(**params)
+        return {feature: values[:, position] for feature, values in self.values.items()}
+
+    def to_dataframe(self, feature):
+        """One row per event, one column per parameter set"""
+        columns = pd.MultiIndex.from_frame(self.params)
+        return pd.DataFrame(self.values[feature], index=pd.Index(self.event_id, name="event_id"), columns=columns)
+
+    def align(self, event_ids):
+        """The cube on the sorted event index event_ids, events without a row get NaN"""
+        positions = np.searchsorted(event_ids, self.event_id)
+        values = {}
+        for feature, feature_values in self.values.items():
+            aligned = np.full((len(event_ids), feature_values.shape[1]), np.nan)
+            aligned[positions] = feature_values
+            values[feature] = aligned
+        return FeatureCube(event_ids, self.params, values)
+
+    def __repr__(self):
+        return f"FeatureCube({len(self)} events, {len(self.params)} parameter sets, features {list(self.values)})"
+
+
+def light_window_sweep(histogram, windows):
+    """
+    Number of hits per event in every window [tmin, tmax).
+
+    The hits are counted once between consecutive window edges, the cumulative sum over the edges then
+    gives every window as the difference of two columns.
+    """
+    edges = np.unique([edge for window in windows for edge in window if np.isfinite(edge)])
+    histogram.check_edges(*edges)
+    n_events = len(histogram)
+
+    # number of edges <= the start of the bin of every entry, hits between consecutive edges per event
+    between = np.searchsorted(edges, histogram.time_bin * histogram.bin_width, side="right")
+    counts = np.bincount(histogram.segments() * (len(edges) + 1) + between, weights=histogram.count,
+                         minlength=n_events * (len(edges) + 1)).reshape(n_events, len(edges) + 1)
+    # below[:, j]: hits earlier than edges[j], the last column holds all hits
+    below = np.cumsum(counts, axis=1).astype(np.int64)
+
+    def hits_before(edge):
+        if edge == -np.inf:
+            return np.zeros(n_events, dtype=np.int64)
+        if edge == np.inf:
+            return below[:, -1]
+        return below[:, np.searchsorted(edges, edge)]
+
+    params = pd.DataFrame(list(windows), columns=["tmin", "tmax"])
+    values = np.column_stack([hits_before(tmax) - hits_before(tmin) for tmin, tmax in windows])
+    return FeatureCube(histogram.event_id, params, {"hits": values.reshape(n_events, len(params))})
+
+
+def brightest_window_sweep(histogram, widths):
+    """Start time of the brightest window of every width within the first µs, on the exact prompt hit times"""
+    if histogram.prompt_window < 1e3:
+        raise ValueError(f"The histogram keeps exact times only up to {histogram.prompt_window} ns, 1000 ns are needed.")
+    n_events = len(histogram)
+    prompt_segment = np.repeat(np.arange(n_events), np.diff(histogram.prompt_offsets))
+    first_us = histogram.prompt_time < 1e3
+    values = np.column_stack([
+        brightest_window_start(prompt_segment[first_us], histogram.prompt_time[first_us], n_events, width)
+        for width in widths
+    ])
+    params = pd.DataFrame({"width": list(widths)})
+    return FeatureCube(histogram.event_id, params, {"start": values.reshape(n_events, len(params))})
+
+
+def interval_sweep(histogram, ranges, widths, min_detectors):
+    """
+    Number, mean and standard deviation of the mid points of the intervals with hits in >= min_detectors
+    detectors for every (tmin, tmax) range, interval width and threshold.
+
+    The detectors per interval are counted once per range and width, all thresholds reuse them.
+    """
+    n_events = len(histogram)
+    segment = histogram.segments()
+    bin_start = histogram.time_bin * histogram.bin_width
+
+    params = []
+    n_intervals, mean, std = [], [], []
+    for (tmin, tmax), width in product(ranges, widths):
+        histogram.check_edges(tmin, tmax, width)
+        interval_segment, mids, n_detectors = interval_detector_counts(segment, bin_start, histogram.det_uid,
+                                                                       tmin, tmax, width)
+        for threshold in min_detectors:
+            good = n_detectors >= threshold
+            moments = interval_moments(interval_segment[good], mids[good], n_events)
+            for values, moment in zip((n_intervals, mean, std), moments):
+                values.append(moment)
+            params.append((tmin, tmax, width, threshold))
+
+    params = pd.DataFrame(params, columns=["tmin", "tmax", "width", "min_detectors"])
+    values = {
+        "n_intervals": np.column_stack(n_intervals).reshape(n_events, len(params)),
+        "mean_timestamp": np.column_stack(mean).reshape(n_events, len(params)),
+        "std_timestamp": np.column_stack(std).reshape(n_events, len(params)),
+    }
+    return FeatureCube(histogram.event_id, params, values)
+
+
+def scintillator_window_sweep(scintillator_data, windows_us, optical_map=None, jit=None):
+    """max_10us_* scintillator features for every sliding window length (µs), the photons are sampled once"""
+    inputs = scintillator_window_inputs(scintillator_data, optical_map)
+    n_events = len(inputs["event_id"])
+    columns = {name: [] for name in ("max_weighted_energy", "max_weighted_energy_xenon",
+                                     "max_n_photons", "max_n_photons_xenon")}
+    # scintillator_window_inputs records its own stages, only the sliding windows are timed here
+    with stage("scintillator_sweep") as record:
+        for window_us in windows_us:
+            for suffix in ("", "_xenon"):
+                max_sum, max_n_photons = sliding_window_max(inputs["starts"], inputs["time"],
+                                                            inputs[f"weighted_edep{suffix}"],
+                                                            inputs[f"n_photons{suffix}"], window_us * 1e3, jit)
+                columns[f"max_weighted_energy{suffix}"].append(max_sum)
+                columns[f"max_n_photons{suffix}"].append(max_n_photons * SIPM_DET_EFFICIENCY)
+        record["rows"] = len(inputs["time"])
+        record["parameter_sets"] = len(windows_us)
+    params = pd.DataFrame({"window_us": list(windows_us)})
+    values = {name: np.column_stack(column).reshape(n_events, len(params)) for name, column in columns.items()}
+    return FeatureCube(inputs["event_id"], params, values)
+
+
+def sweep_event_features(scintillator_data=None, optical_data=None,
+                         light_windows=((-np.inf, 1e3), (1e3, 10e3), (10e3, 200e3)),
+                         brightest_widths=(60,),
+                         interval_ranges=((1e3, 10e3), (10e3, 200e3)), interval_widths=(200,), min_detectors=(6,),
+                         scintillator_windows_us=(10,), optical_map=None, bin_width=10.0, jit=None):
+    """
+    All feature variants of a run (or chunk) in one pass.
+
+    optical_data: the optical hits or their OpticalHistogram.
+    light_windows: (tmin, tmax) windows of the integral light in ns.
+    brightest_widths: widths (ns) of the brightest window within the first µs.
+    interval_ranges, interval_widths, min_detectors: every combination of the interval features.
+    scintillator_windows_us: lengths of the scintillator sliding window.
+    bin_width: histogram bin width if optical_data are raw hits.
+
+    Returns:
+    dict "light", "brightest_window", "intervals", "scintillator" -> FeatureCube, all on the
+    same sorted event index (the union of the events of both tables). Missing inputs are left out.
+    """
+    cubes = {}
+    if optical_data is not None and len(optical_data) > 0:
+        if not isinstance(optical_data, OpticalHistogram):
+            with stage("optical_histogram") as record:
+                optical_data = OpticalHistogram.from_optical_data(optical_data, bin_width)
+                record["events"] = len(optical_data)
+        with stage("optical_sweep") as record:
+            cubes["light"] = light_window_sweep(optical_data, light_windows)
+            cubes["brightest_window"] = brightest_window_sweep(optical_data, brightest_widths)
+            cubes["intervals"] = interval_sweep(optical_data, interval_ranges, interval_widths, min_detectors)
+            record["events"] = len(optical_data)
+            record["parameter_sets"] = sum(len(cube.params) for cube in cubes.values())
+    if scintillator_data is not None and len(scintillator_data) > 0:
+        cubes["scintillator"] = scintillator_window_sweep(scintillator_data, scintillator_windows_us, optical_map, jit)
+
+    if not cubes:
+        return cubes
+    event_ids = np.unique(np.concatenate([cube.event_id for cube in cubes.values()]))
+    return {name: cube.align(event_ids) for name, cube in cubes.items()}
@@ -0,0 +1,224 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+import h5py
+
+from processing import convert_to_event_structure, EventTable, EVENT_FIELDS, OpticalHistogram
+from read_and_write import (read_data, read_thread_file, dtype_policy, DEFAULT_TABLES, write_optical_histogram,
+                            read_optical_histogram)
+from feature_cache import FeatureCache
+from weights import OpticalMap
+
+
+def thread_file_paths(output_directory, file_extension="lh5", nr_of_threads=16):
+    """Paths of the out_t{i} files of a run"""
+    return [f"{output_directory}/out_t{i}.{file_extension}" for i in range(nr_of_threads)]
+
+
+def sort_by_event_id(table):
+    """EventTable sorted by event_id, the order convert_to_event_structure gives for a whole run"""
+    return table[np.argsort(table["event_id"], kind="stable")]
+
+
+def check_event_id_collisions(shards, file_paths):
+    """Raise a ValueError if an event_id appears in more than one shard (thread file)"""
+    event_ids = np.concatenate([np.unique(shard["event_id"]) for shard in shards]) if shards else np.array([])
+    unique, counts = np.unique(event_ids, return_counts=True)
+    duplicated = unique[counts > 1]
+    if len(duplicated) > 0:
+        files = [path for path, shard in zip(file_paths, shards) if np.any(np.isin(shard["event_id"], duplicated))]
+        raise ValueError(f"{len(duplicated)} event ids appear in more than one thread file "
+                         f"(e.g. {duplicated[:5].tolist()}) in {files}.")
+
+
+def process_thread_file(file_path, file_extension="lh5", tables=DEFAULT_TABLES, optical_map=None,
+                        time_min=10.0 * 1e3, time_max=1.0 * 1e6, columns=None, dtypes=None, **feature_params):
+    """
+    Read one thread file and compute the features of its events.
+
+    Geant4 assigns whole events to threads, so the events of a file are complete.
+    feature_params: passed on to convert_to_event_structure (window_us, track_params).
+    """
+    data = read_thread_file(file_path, file_extension, tables, time_min, time_max, columns, dtypes=dtypes)
+    return convert_to_event_structure(data.get("scintillator"), data.get("optical"), data.get("germanium"),
+                                      data.get("tracks"), optical_map, **feature_params)
+
+
+def optical_histogram_is_current(path, file_paths, bin_width, prompt_window):
+    """True if the histogram file exists, has this binning and is newer than every thread file.
+    Histograms with int32 time bins (written before they were int64) may hold wrapped bins and are rebuilt."""
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, "r") as f:
+        attrs = f["optical_histogram"].attrs
+        if f["optical_histogram"]["time_bin"].dtype != np.int64:
+            return False
+        same_binning = attrs["bin_width"] == bin_width and attrs["prompt_window"] == prompt_window
+        same_files = list(attrs.get("sources", [])) == [os.path.basename(p) for p in file_paths]
+    mtime = os.path.getmtime(path)
+    return same_binning and same_files and all(os.path.getmtime(p) <= mtime for p in file_paths)
+
+
+def cached_optical_histogram(output_directory, file_extension="lh5", nr_of_threads=16, path=None,
+                             bin_width=10.0, prompt_window=1e3, force=False):
+    """
+    OpticalHistogram of a run, built from the raw optical hits only once.
+
+    The histogram is written to path (default <output_directory>/optical_histogram.h5) and read from there
+    as long as it is newer than the thread files and has the same binning. It can be passed as optical
+    data to convert_to_event_structure instead of the stp/optical table.
+    """
+    if path is None:
+        path = os.path.join(output_directory, "optical_histogram.h5")
+    file_paths = thread_file_paths(output_directory, file_extension, nr_of_threads)
+    if not force and optical_histogram_is_current(path, file_paths, bin_width, prompt_window):
+        return read_optical_histogram(path)
+
+    # one thread file at a time, only the histogram of a file is kept
+    histograms = []
+    for file_path in file_paths:
+        optical_data = read_thread_file(file_path, file_extension, tables=("optical",))["optical"]
+        if optical_data is not None:
+            histograms.append(OpticalHistogram.from_optical_data(optical_data, bin_width, prompt_window))
+        del optical_data
+    if not histograms:
+        raise ValueError(f"No optical data found in {output_directory}.")
+    histogram = OpticalHistogram.concatenate(histograms)
+    write_optical_histogram(histogram, path, attrs={"sources": [os.path.basename(p) for p in file_paths]})
+    return histogram
+
+
+def cached_event_structure(output_directory, file_extension="lh5", nr_of_threads=16, cache=None, optical_map=None,
+                           tables=DEFAULT_TABLES, time_min=10.0 * 1e3, time_max=1.0 * 1e6, columns=None,
+                           dtypes=None, **feature_params):
+    """
+    read_data + convert_to_event_structure with a per thread file FeatureCache.
+
+    Only thread files that changed since the last call, or that were never processed with these
+    parameters and this optical map version, are read and processed again.
+
+    Returns:
+    The EventTable of the run, sorted by event_id like convert_to_event_structure.
+    """
+    if cache is None:
+        cache = FeatureCache()
+    return parallel_event_structure(output_directory, file_extension, nr_of_threads, workers=1, cache=cache,
+                                    optical_map=optical_map, tables=tables, time_min=time_min, time_max=time_max,
+                                    columns=columns, dtypes=dtypes, **feature_params)
+
+
+def parallel_event_structure(output_directory, file_extension="lh5", nr_of_threads=16, workers=None, cache=None,
+                             optical_map=None, tables=DEFAULT_TABLES, time_min=10.0 * 1e3, time_max=1.0 * 1e6,
+                             columns=None, dtypes=None, **feature_params):
+    """
+    read_data + convert_to_event_structure with every thread file processed in its own process.
+
+    workers: size of the process pool, default os.cpu_count().
+    cache: optional FeatureCache, thread files found in it are not processed again.
+    The shards are merged in thread file order and sorted by event_id, so the result does not depend on
+    the number of workers. A ValueError is raised if an event_id appears in more than one thread file.
+    """
+    if optical_map is None:
+        optical_map = OpticalMap()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    file_paths = thread_file_paths(output_directory, file_extension, nr_of_threads)
+    shards = [None] * len(file_paths)
+    keys = [None] * len(file_paths)
+
+    if cache is not None:
+        # everything the features of a thread file depend on apart from the file itself
+        params = {
+            "tables": list(tables),
+            "time_min": time_min,
+            "time_max": time_max,
+            "columns": columns,
+            "dtypes": {name: np.dtype(dtype).name for name, dtype in dtype_policy(dtypes).items()},
+            "optical_map": optical_map.version(),
+            **feature_params,
+        }
+        for i, file_path in enumerate(file_paths):
+            keys[i] = cache.key(file_path, params)
+            shards[i] = cache.get(keys[i])
+
+    missing = [i for i, shard in enumerate(shards) if shard is None]
+    process_file = partial(process_thread_file, file_extension=file_extension, tables=tables, optical_map=optical_map,
+                           time_min=time_min, time_max=time_max, columns=columns, dtypes=dtypes, **feature_params)
+    if workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            computed = list(executor.map(process_file, [file_paths[i] for i in missing]))
+    else:
+        computed = [process_file(file_paths[i]) for i in missing]
+
+    for i, table in zip(missing, computed):
+        shards[i] = table
+        if cache is not None:
+            cache.put(keys[i], table, source=file_paths[i])
+
+    check_event_id_collisions(shards, file_paths)
+    return sort_by_event_id(EventTable.concatenate(shards))
+
+
+# photon numbers are sampled by emitted_scintillation_photons, they differ between any two runs
+SAMPLED_FIELDS = ("max_10us_n_photons", "max_10us_n_photons_xenon")
+
+
+def compare_event_tables(reference, other, rtol=0.0):
+    """
+    Per Event field: number of events whose value differs (NaN equals NaN) and the largest absolute
+    and relative difference. Only events present in both tables are compared.
+    """
+    common, i_reference, i_other = np.intersect1d(reference["event_id"], other["event_id"], return_indices=True)
+    report = {
+        "events": len(common),
+        "only_in_reference": len(reference) - len(common),
+        "only_in_other": len(other) - len(common),
+        "fields": {},
+    }
+    for name in EVENT_FIELDS[1:]:
+        a = np.asarray(reference[name], dtype=float)[i_reference]
+        b = np.asarray(other[name], dtype=float)[i_other]
+        same = np.isclose(a, b, rtol=rtol, atol=0.0, equal_nan=True)
+        difference = np.abs(a - b)[~same]
+        scale = np.abs(a)[~same]
+        report["fields"][name] = {
+            "changed": int(np.count_nonzero(~same)),
+            "max_abs_diff": float(difference.max()) if len(difference) else 0.0,
+            "max_rel_diff": float(np.max(difference / np.where(scale > 0, scale, 1.0))) if len(difference) else 0.0,
+            "example_events": common[~same][:5].tolist(),
+        }
+    return report
+
+
+def validate_dtype_policy(output_directory, file_extension="lh5", nr_of_threads=16, dtypes="compact",
+                          optical_map=None, rtol=0.0, **feature_params):
+    """
+    Process a run once with the on-disk dtypes and once with a compact dtype policy and report which
+    Event features the downcast changes (see compare_event_tables), printed and returned.
+
+    The photon number features are sampled and differ between any two runs, their changes are
+    listed but not counted as caused by the dtype policy.
+    """
+    if optical_map is None:
+        optical_map = OpticalMap()
+    tables = {}
+    for label, policy in (("reference", None), ("policy", dtypes)):
+        data = read_data(output_directory, file_extension, nr_of_threads, dtypes=policy)
+        tables[label] = convert_to_event_structure(*data, optical_map=optical_map, **feature_params)
+        del data
+
+    report = compare_event_tables(tables["reference"], tables["policy"], rtol)
+    print(f"dtype policy {dtypes}: {report['events']} events compared, "
+          f"{report['only_in_reference'] + report['only_in_other']} events only in one of the runs")
+    for name, entry in report["fields"].items():
+        if entry["changed"] == 0:
+            continue
+        note = " (sampled, differs anyway)" if name in SAMPLED_FIELDS else ""
+        print(f"    {name}: {entry['changed']} events changed, max abs diff {entry['max_abs_diff']:.3g}, "
+              f"max rel diff {entry['max_rel_diff']:.3g}{note}, e.g. events {entry['example_events']}")
+    report["changed_fields"] = [name for name, entry in report["fields"].items()
+                                if entry["changed"] > 0 and name not in SAMPLED_FIELDS]
+    return report
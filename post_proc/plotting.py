@@ -2,7 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 
-def plot_event_distribution(x_values, y_values, ge77_values, plot_subplots=True, plot_green_cdf=True, save_path=None, x_label=None, y_label=None, alpha = 1.0):
+def plot_event_distribution(x_values, y_values, ge77_values, plot_subplots=True, plot_green_cdf=True, save_path=None, x_label=None, y_label=None, alpha = 1.0, argon_threshold=35, neutron_threshold=7):
     # Masks
     mask_no_ge77 = ge77_values == 0
     mask_ge77 = ge77_values > 0
@@ -47,9 +47,9 @@ def plot_event_distribution(x_values, y_values, ge77_values, plot_subplots=True,
     ax_main.set_yscale('log')
 
 
-    ax_main.hlines(35, xmin=1e-3, xmax=x_values.max(),
+    ax_main.hlines(argon_threshold, xmin=1e-3, xmax=x_values.max(),
                    color='orange', linestyle='--', label='Argon Threshold')
-    ax_main.vlines(7, ymin=1e-3, ymax=y_values.max(),
+    ax_main.vlines(neutron_threshold, ymin=1e-3, ymax=y_values.max(),
                    color='blue', linestyle='--', label='Neutron Threshold')
 
     ax_main.legend()
@@ -108,3 +108,29 @@ def plot_event_distribution(x_values, y_values, ge77_values, plot_subplots=True,
     if save_path is not None:
         plt.savefig(save_path)
     plt.show()
+
+
+def plot_veto_surface(surface, working_point=None, save_path=None):
+    # Efficiency and dead fraction of a veto.VetoSurface over the threshold grid,
+    # neutron thresholds on the x axis and argon thresholds on the y axis like plot_event_distribution
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5), sharey=True)
+    for ax, values, title in zip(axes, (surface.efficiency, surface.dead_fraction),
+                                 ("Ge-77 tagging efficiency", "Vetoed muons without Ge-77")):
+        mesh = ax.pcolormesh(surface.neutron_thresholds, surface.argon_thresholds, values,
+                             shading='nearest', vmin=0, vmax=1)
+        contours = ax.contour(surface.neutron_thresholds, surface.argon_thresholds, values,
+                              levels=[0.5, 0.8, 0.9, 0.95, 0.99], colors='white', linewidths=0.8)
+        ax.clabel(contours, fontsize=8)
+        fig.colorbar(mesh, ax=ax)
+        if working_point is not None:
+            ax.scatter(working_point["neutron_threshold"], working_point["argon_threshold"],
+                       marker='x', s=60, color='red', label='Working point')
+            ax.legend()
+        ax.set_title(f"{title} ({surface.logic.upper()})")
+        ax.set_xlabel("Neutron Threshold")
+    axes[0].set_ylabel("Argon Threshold")
+
+    plt.tight_layout()
+    if save_path is not None:
+        plt.savefig(save_path)
+    plt.show()
@@ -1,11 +1,17 @@
 
 import pandas as pd
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 import numpy as np
 import awkward as ak
 from reboost.spms.pe import emitted_scintillation_photons
 
-from weights import get_weighted_energy
+from weights import OpticalMap
+from profiling import stage
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 @dataclass
 class Event:
@@ -28,107 +34,570 @@ class Event:
     max_10us_weighted_energy_xenon: float # weighted energy deposition in the ALAR region maximum value in a 10 microsecond window with xenon_weights
 
 
-import pandas as pd
-import numpy as np
-import awkward as ak
+EVENT_FIELDS = [f.name for f in fields(Event)]
+
+
+class EventTable:
+    """
+    Columnar table of events with the fields of Event, one NumPy array per field.
+
+    table["ge77_count"] returns the column without copying, table[i] the Event of row i and
+    table[mask] (boolean mask, index array or slice) a new EventTable. Runs are combined with
+    run8 + run7 or EventTable.concatenate. Iterating yields Event objects, so code written for
+    a list of events keeps working.
+    """
+
+    def __init__(self, columns):
+        missing = [name for name in EVENT_FIELDS if name not in columns]
+        if missing:
+            raise ValueError(f"Missing event columns {missing}.")
+        self.columns = {name: np.asarray(columns[name]) for name in EVENT_FIELDS}
+        lengths = {len(column) for column in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Event columns have different lengths {sorted(lengths)}.")
+
+    @classmethod
+    def from_dataframe(cls, df):
+        return cls({name: df[name].to_numpy() for name in EVENT_FIELDS})
+
+    @classmethod
+    def from_events(cls, events):
+        return cls({name: np.array([getattr(ev, name) for ev in events]) for name in EVENT_FIELDS})
+
+    @classmethod
+    def concatenate(cls, tables):
+        tables = list(tables)
+        if not tables:
+            return cls({name: np.array([]) for name in EVENT_FIELDS})
+        return cls({name: np.concatenate([t.columns[name] for t in tables]) for name in EVENT_FIELDS})
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns)
+
+    def to_events(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self.columns["event_id"])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            return Event(**{name: column[key].item() for name, column in self.columns.items()})
+        return EventTable({name: column[key] for name, column in self.columns.items()})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __add__(self, other):
+        if not isinstance(other, EventTable):
+            other = EventTable.from_events(other)
+        return EventTable.concatenate([self, other])
+
+    def __repr__(self):
+        return f"EventTable({len(self)} events)"
+
+
+def segment_starts(evtid):
+    """Start offsets of the runs of equal evtid in an evtid-sorted array, with len(evtid) appended"""
+    if len(evtid) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.diff(evtid)) + 1
+    return np.concatenate([[0], starts, [len(evtid)]]).astype(np.int64)
+
+
+def count_in_window(segment, mask, n_segments):
+    """Number of rows per segment where mask is true"""
+    return np.bincount(segment[mask], minlength=n_segments)
+
+
+def shifted_segment_times(starts, run, time, width):
+    """
+    Shift every segment of segment-wise sorted times behind the previous one, so one searchsorted
+    over all rows finds window bounds in all segments at once. The shift can be off by an ulp against
+    a time[j] - time[i] <= width comparison, so callers correct the bounds on the original times.
+    """
+    segment_min = np.minimum.reduceat(time, starts[:-1])
+    span = np.maximum.reduceat(time, starts[:-1]) - segment_min + 2 * width + 1
+    offset = np.concatenate([[0.0], np.cumsum(span)[:-1]])
+    return time - segment_min[run] + offset[run]
+
+
+def brightest_window_start(segment, time, n_segments, width=60.0):
+    """
+    Start time of the window [t_i, t_i + width] containing the most hits, per segment.
+
+    time must be sorted within every segment. Ties go to the earliest start, segments without hits get NaN.
+    """
+    best_time = np.full(n_segments, np.nan)
+    if len(time) == 0:
+        return best_time
+
+    starts = segment_starts(segment)
+    run = np.repeat(np.arange(len(starts) - 1), np.diff(starts))
+    segment_end = starts[1:][run]
+    index = np.arange(len(time))
+
+    # first hit later than width after every hit
+    shifted = shifted_segment_times(starts, run, time, width)
+    end = np.searchsorted(shifted, shifted + width, side="right")
+    end = np.clip(np.maximum(end, index + 1), None, segment_end)
+    while True:
+        up = end < segment_end
+        up[up] = (time[end[up]] - time[up]) <= width
+        if not np.any(up):
+            break
+        end[up] += 1
+    while True:
+        down = end > index + 1
+        down[down] = (time[end[down] - 1] - time[down]) > width
+        if not np.any(down):
+            break
+        end[down] -= 1
+
+    count = end - index
+    max_count = np.maximum.reduceat(count, starts[:-1])
+    is_best = count == max_count[run]
+    first_best = np.flatnonzero(is_best)
+    best_segment, first = np.unique(segment[first_best], return_index=True)
+    best_time[best_segment] = time[first_best[first]]
+    return best_time
+
+
+def interval_stats(segment, time, det_uid, n_segments, tmin, tmax, bin_width=200, min_detectors=6):
+    """
+    Non-overlapping bin_width intervals between tmin and tmax with hits in >= min_detectors detectors, per segment.
+
+    Returns the number of such intervals, the mean and the standard deviation of their mid points.
+    The number is a float like in the pandas implementation, mean and std are NaN without intervals.
+    """
+    interval_segment, mids, n_detectors = interval_detector_counts(segment, time, det_uid, tmin, tmax, bin_width)
+    good = n_detectors >= min_detectors
+    return interval_moments(interval_segment[good], mids[good], n_segments)
+
+
+def interval_detector_counts(segment, time, det_uid, tmin, tmax, bin_width=200):
+    """
+    Number of distinct detectors in every non-overlapping bin_width interval between tmin and tmax
+    that has hits, per segment.
+
+    Returns the segment, the mid point and the number of detectors of every such interval.
+    """
+    in_range = (time >= tmin) & (time < tmax)
+    bins = np.arange(tmin, tmax + bin_width, bin_width)
+    segment = segment[in_range]
+    bin_idx = np.digitize(time[in_range], bins) - 1  # -1 because digitize is 1-based
+    det_uid = det_uid[in_range]
+    if len(segment) == 0:
+        return segment, np.array([], dtype=float), np.array([], dtype=np.int64)
+
+    # unique (segment, bin, detector) triples, then number of detectors per (segment, bin)
+    order = np.lexsort((det_uid, bin_idx, segment))
+    segment, bin_idx, det_uid = segment[order], bin_idx[order], det_uid[order]
+    new_triple = np.ones(len(segment), dtype=bool)
+    new_triple[1:] = (segment[1:] != segment[:-1]) | (bin_idx[1:] != bin_idx[:-1]) | (det_uid[1:] != det_uid[:-1])
+    segment, bin_idx = segment[new_triple], bin_idx[new_triple]
+
+    new_bin = np.ones(len(segment), dtype=bool)
+    new_bin[1:] = (segment[1:] != segment[:-1]) | (bin_idx[1:] != bin_idx[:-1])
+    bin_starts = np.flatnonzero(new_bin)
+    n_detectors = np.diff(np.append(bin_starts, len(segment)))
+    return segment[bin_starts], bins[bin_idx[bin_starts]] + bin_width / 2, n_detectors
+
+
+def interval_moments(good_segment, mids, n_segments):
+    """Number, mean and standard deviation of the interval mid points per segment, NaN without intervals"""
+    n_intervals = np.zeros(n_segments)
+    mean = np.full(n_segments, np.nan)
+    std = np.full(n_segments, np.nan)
+
+    n_good = np.bincount(good_segment, minlength=n_segments)
+    has_intervals = n_good > 0
+    n_intervals[:] = n_good
+    mean[has_intervals] = np.bincount(good_segment, weights=mids, minlength=n_segments)[has_intervals] / n_good[has_intervals]
+    squared_deviation = (mids - mean[good_segment]) ** 2
+    std[has_intervals] = np.sqrt(
+        np.bincount(good_segment, weights=squared_deviation, minlength=n_segments)[has_intervals] / n_good[has_intervals]
+    )
+    return n_intervals, mean, std
+
 
 def compute_optical_features(optical_data):
-    # --- Convert to DataFrame ---
-    df = pd.DataFrame({
-        "event_id": ak.to_numpy(optical_data.evtid),
-        "time": ak.to_numpy(optical_data.time),
-        "det_uid": ak.to_numpy(optical_data.det_uid),
-    })
-    g = df.groupby("event_id")
+    """
+    Optical features per event, computed on flat arrays sorted once by (evtid, time).
+    Every event is a contiguous segment, all features are segment reductions without per-event Python calls.
+    """
+    evtid = ak.to_numpy(optical_data.evtid)
+    time = ak.to_numpy(optical_data.time).astype(float)
+    det_uid = ak.to_numpy(optical_data.det_uid)
+
+    order = np.lexsort((time, evtid))
+    evtid, time, det_uid = evtid[order], time[order], det_uid[order]
+
+    starts = segment_starts(evtid)
+    n_events = len(starts) - 1
+    segment = np.repeat(np.arange(n_events), np.diff(starts))
 
     # --- Basic time window hit counts ---
-    n_first_us = g["time"].apply(lambda x: np.sum(x < 1e3)).reset_index(name="il_first_us")
-    n_1_10_us = g["time"].apply(lambda x: np.sum((x >= 1e3) & (x < 10e3))).reset_index(name="il_1_10_us")
-    n_10_200_us = g["time"].apply(lambda x: np.sum((x >= 10e3) & (x < 200e3))).reset_index(name="il_10_200_us")
+    result = pd.DataFrame({
+        "event_id": evtid[starts[:-1]],
+        "il_first_us": count_in_window(segment, time < 1e3, n_events),
+        "il_1_10_us": count_in_window(segment, (time >= 1e3) & (time < 10e3), n_events),
+        "il_10_200_us": count_in_window(segment, (time >= 10e3) & (time < 200e3), n_events),
+    })
 
     # --- Brightest 60 ns window within first 1 µs ---
-    def brightest_60ns(sub):
-        sub = sub[sub.time < 1e3].sort_values("time")
-        times = sub["time"].values
-        if len(times) == 0:
-            return np.nan
-        max_count = 0
-        best_time = np.nan
-        j = 0
-        for i in range(len(times)):
-            while j < len(times) and times[j] - times[i] <= 60:
-                j += 1
-            count = j - i
-            if count > max_count:
-                max_count = count
-                best_time = times[i]
-        return best_time
+    first_us = time < 1e3
+    result["timestamp_brightest_60ns_window_1us"] = brightest_window_start(segment[first_us], time[first_us], n_events)
 
-    timestamp_brightest = g.apply(brightest_60ns, include_groups=False).reset_index(name="timestamp_brightest_60ns_window_1us")
-
-    # --- Helper for 200 ns interval stats ---
-    def interval_stats(sub, tmin, tmax):
-        sub = sub[(sub.time >= tmin) & (sub.time < tmax)]
-        if sub.empty:
-            return pd.Series([0, np.nan, np.nan])
-        times = sub["time"].values
-        bins = np.arange(tmin, tmax + 200, 200)
-        # Assign each event to a bin
-        bin_idx = np.digitize(sub.time.values, bins) - 1  # -1 because digitize is 1-based
-        sub = sub.assign(bin=bin_idx)
-
-        # Count unique detectors per bin
-        det_counts = sub.groupby("bin")["det_uid"].nunique()
-    
-        # Select bins with >6 unique detectors
-        good_bins = det_counts[det_counts >= 6].index
-        if len(good_bins) == 0:
-            return pd.Series([0, np.nan, np.nan])
-
-        mids = bins[good_bins] + 100
-        return pd.Series([len(mids), np.mean(mids), np.std(mids)])
-
-    # Apply and name columns
-    interval_1_10 = (
-        g.apply(lambda x: interval_stats(x, 1e3, 10e3), include_groups=False)
-        .reset_index()
-        .rename(columns={
-            0: "n_200ns_intervals_1_10_us",
-            1: "mean_timestamp_intervals_1_10_us",
-            2: "std_timestamp_intervals_1_10_us"
-        })
-    )
+    # --- 200 ns interval stats ---
+    for tmin, tmax, suffix in [(1e3, 10e3, "1_10_us"), (10e3, 200e3, "10_200_us")]:
+        n_intervals, mean, std = interval_stats(segment, time, det_uid, n_events, tmin, tmax)
+        result[f"n_200ns_intervals_{suffix}"] = n_intervals
+        result[f"mean_timestamp_intervals_{suffix}"] = mean
+        result[f"std_timestamp_intervals_{suffix}"] = std
 
-    interval_10_200 = (
-        g.apply(lambda x: interval_stats(x, 10e3, 200e3), include_groups=False)
-        .reset_index()
-        .rename(columns={
-            0: "n_200ns_intervals_10_200_us",
-            1: "mean_timestamp_intervals_10_200_us",
-            2: "std_timestamp_intervals_10_200_us"
-        })
-    )
+    return result
 
-    # --- Merge all results on event_id ---
-    result = (
-        n_first_us
-        .merge(n_1_10_us, on="event_id")
-        .merge(n_10_200_us, on="event_id")
-        .merge(timestamp_brightest, on="event_id")
-        .merge(interval_1_10, on="event_id")
-        .merge(interval_10_200, on="event_id")
+
+class OpticalHistogram:
+    """
+    The optical hits of every event reduced to a sparse histogram: the number of hits per
+    (time bin, det_uid) with bins of bin_width ns, plus the exact times of the hits before
+    prompt_window for the brightest 60 ns window.
+
+    The entries of event i are time_bin/det_uid/count[offsets[i]:offsets[i + 1]], sorted by
+    (time_bin, det_uid), its prompt hit times prompt_time[prompt_offsets[i]:prompt_offsets[i + 1]].
+    compute_optical_features_from_histogram gives the same features as compute_optical_features
+    for all windows whose edges are multiples of bin_width. Stored with write_optical_histogram,
+    built once per run with pipeline.cached_optical_histogram.
+    """
+
+    def __init__(self, event_id, offsets, time_bin, det_uid, count, prompt_offsets, prompt_time,
+                 bin_width=10.0, prompt_window=1e3):
+        self.event_id = np.asarray(event_id)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.time_bin = np.asarray(time_bin)
+        self.det_uid = np.asarray(det_uid)
+        self.count = np.asarray(count)
+        self.prompt_offsets = np.asarray(prompt_offsets, dtype=np.int64)
+        self.prompt_time = np.asarray(prompt_time)
+        self.bin_width = float(bin_width)
+        self.prompt_window = float(prompt_window)
+
+    @classmethod
+    def from_hits(cls, evtid, time, det_uid, bin_width=10.0, prompt_window=1e3):
+        evtid = np.asarray(evtid)
+        time = np.asarray(time, dtype=float)
+        det_uid = np.asarray(det_uid)
+
+        # floor(time / bin_width), corrected where the division rounds across a bin edge
+        time_bin = np.floor(time / bin_width).astype(np.int64)
+        time_bin[time_bin * bin_width > time] -= 1
+        time_bin[(time_bin + 1) * bin_width <= time] += 1
+
+        # exact prompt hit times, sorted by (evtid, time)
+        prompt = np.flatnonzero(time < prompt_window)
+        prompt = prompt[np.lexsort((time[prompt], evtid[prompt]))]
+        prompt_evtid, prompt_time = evtid[prompt], time[prompt]
+
+        # one entry per (evtid, time_bin, det_uid) with its number of hits
+        order = np.lexsort((det_uid, time_bin, evtid))
+        evtid, time_bin, det_uid = evtid[order], time_bin[order], det_uid[order]
+        new_entry = np.ones(len(evtid), dtype=bool)
+        new_entry[1:] = (evtid[1:] != evtid[:-1]) | (time_bin[1:] != time_bin[:-1]) | (det_uid[1:] != det_uid[:-1])
+        entry_starts = np.flatnonzero(new_entry)
+        count = np.diff(np.append(entry_starts, len(evtid)))
+        entry_evtid = evtid[entry_starts]
+
+        offsets = segment_starts(entry_evtid)
+        event_id = entry_evtid[offsets[:-1]]
+        prompt_counts = np.bincount(np.searchsorted(event_id, prompt_evtid), minlength=len(event_id))
+        prompt_offsets = np.concatenate([[0], np.cumsum(prompt_counts)])
+
+        # time_bin stays int64, int32 wraps for hits later than about 21 s (decays of long-lived nuclei)
+        return cls(event_id, offsets, time_bin[entry_starts], det_uid[entry_starts].astype(np.int32),
+                   count.astype(np.int32), prompt_offsets, prompt_time, bin_width, prompt_window)
+
+    @classmethod
+    def from_optical_data(cls, optical_data, bin_width=10.0, prompt_window=1e3):
+        return cls.from_hits(ak.to_numpy(optical_data.evtid), ak.to_numpy(optical_data.time),
+                             ak.to_numpy(optical_data.det_uid), bin_width, prompt_window)
+
+    @classmethod
+    def concatenate(cls, histograms):
+        """Histograms of different events (e.g. of the thread files) with the same binning combined into one"""
+        histograms = list(histograms)
+        binning = {(h.bin_width, h.prompt_window) for h in histograms}
+        if len(binning) > 1:
+            raise ValueError(f"Histograms with different binning {sorted(binning)} can not be combined.")
+
+        def combined_offsets(offsets):
+            shifts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+            return np.concatenate([[0]] + [o[1:] + shift for o, shift in zip(offsets, shifts)])
+
+        return cls(
+            np.concatenate([h.event_id for h in histograms]),
+            combined_offsets([h.offsets for h in histograms]),
+            np.concatenate([h.time_bin for h in histograms]),
+            np.concatenate([h.det_uid for h in histograms]),
+            np.concatenate([h.count for h in histograms]),
+            combined_offsets([h.prompt_offsets for h in histograms]),
+            np.concatenate([h.prompt_time for h in histograms]),
+            *binning.pop(),
+        )
+
+    def check_edges(self, *edges):
+        """Raise a ValueError unless every window edge (ns) is a multiple of bin_width"""
+        for edge in edges:
+            if not np.isclose(edge / self.bin_width, np.round(edge / self.bin_width), rtol=0, atol=1e-9):
+                raise ValueError(f"Window edge {edge} ns is not a multiple of the histogram bin width {self.bin_width} ns.")
+
+    def segments(self):
+        """Event index of every entry"""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def hits_between(self, tmin, tmax):
+        """Number of hits with tmin <= time < tmax per event"""
+        self.check_edges(*(edge for edge in (tmin, tmax) if np.isfinite(edge)))
+        bin_start = self.time_bin * self.bin_width
+        mask = (bin_start >= tmin) & (bin_start < tmax)
+        return np.bincount(self.segments()[mask], weights=self.count[mask], minlength=len(self)).astype(np.int64)
+
+    @property
+    def n_hits(self):
+        return int(self.count.sum())
+
+    def __len__(self):
+        return len(self.event_id)
+
+    def __repr__(self):
+        return (f"OpticalHistogram({len(self)} events, {len(self.count)} entries of {self.n_hits} hits, "
+                f"{self.bin_width:g} ns bins)")
+
+
+def compute_optical_features_from_histogram(histogram, interval_width=200, min_detectors=6):
+    """
+    compute_optical_features on an OpticalHistogram instead of the raw hits, with the same result.
+
+    interval_width, min_detectors: the non-overlapping intervals with hits in >= min_detectors detectors.
+    """
+    n_events = len(histogram)
+    segment = histogram.segments()
+
+    result = pd.DataFrame({
+        "event_id": histogram.event_id,
+        "il_first_us": histogram.hits_between(-np.inf, 1e3),
+        "il_1_10_us": histogram.hits_between(1e3, 10e3),
+        "il_10_200_us": histogram.hits_between(10e3, 200e3),
+    })
+
+    # --- Brightest 60 ns window within first 1 µs, on the exact prompt hit times ---
+    if histogram.prompt_window < 1e3:
+        raise ValueError(f"The histogram keeps exact times only up to {histogram.prompt_window} ns, 1000 ns are needed.")
+    prompt_segment = np.repeat(np.arange(n_events), np.diff(histogram.prompt_offsets))
+    first_us = histogram.prompt_time < 1e3
+    result["timestamp_brightest_60ns_window_1us"] = brightest_window_start(
+        prompt_segment[first_us], histogram.prompt_time[first_us], n_events
     )
 
+    # --- 200 ns interval stats, every entry stands for its bin, which lies in a single interval ---
+    histogram.check_edges(interval_width)
+    bin_start = histogram.time_bin * histogram.bin_width
+    for tmin, tmax, suffix in [(1e3, 10e3, "1_10_us"), (10e3, 200e3, "10_200_us")]:
+        histogram.check_edges(tmin, tmax)
+        n_intervals, mean, std = interval_stats(segment, bin_start, histogram.det_uid, n_events, tmin, tmax,
+                                                interval_width, min_detectors)
+        result[f"n_200ns_intervals_{suffix}"] = n_intervals
+        result[f"mean_timestamp_intervals_{suffix}"] = mean
+        result[f"std_timestamp_intervals_{suffix}"] = std
+
     return result
 
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def _sliding_window_max_jit(starts, time, weights, counts, window):
+        n_segments = len(starts) - 1
+        max_sum = np.zeros(n_segments)
+        max_count = np.zeros(n_segments, dtype=np.int64)
+        for s in range(n_segments):
+            start = starts[s]
+            current_sum = 0.0
+            current_count = 0
+            for end in range(starts[s], starts[s + 1]):
+                current_sum += weights[end]
+                current_count += counts[end]
+                while time[end] - time[start] > window:
+                    current_sum -= weights[start]
+                    current_count -= counts[start]
+                    start += 1
+                if current_sum > max_sum[s]:
+                    max_sum[s] = current_sum
+                    max_count[s] = current_count
+        return max_sum, max_count
+
+
+def sliding_window_max(starts, time, weights, counts, window, jit=None):
+    """
+    Maximum sum of weights in a window of the given length, per segment, and the sum of counts in that window.
+
+    starts are the segment offsets from segment_starts, time must be sorted within every segment.
+    A window ends at every row and reaches back to the earliest row with time[end] - time[start] <= window.
+    Like the original per-event loop the first window with the largest sum wins and segments without a
+    positive sum get (0, 0). Uses a compiled kernel if numba is available (jit=None), else prefix sums.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    time = np.asarray(time, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    counts = np.asarray(counts, dtype=np.int64)
+
+    if jit is None:
+        jit = numba is not None
+    if jit:
+        if numba is None:
+            raise ImportError("numba is required for jit=True.")
+        return _sliding_window_max_jit(starts, time, weights, counts, float(window))
+
+    n_segments = len(starts) - 1
+    max_sum = np.zeros(n_segments)
+    max_count = np.zeros(n_segments, dtype=np.int64)
+    if len(time) == 0:
+        return max_sum, max_count
+
+    run = np.repeat(np.arange(n_segments), np.diff(starts))
+    segment_start = starts[:-1][run]
+    index = np.arange(len(time))
+
+    # first row of the window ending at every row
+    shifted = shifted_segment_times(starts, run, time, window)
+    start = np.searchsorted(shifted, shifted - window, side="left")
+    start = np.clip(np.minimum(start, index), segment_start, None)
+    while True:
+        down = start > segment_start
+        down[down] = (time[down] - time[start[down] - 1]) <= window
+        if not np.any(down):
+            break
+        start[down] -= 1
+    while True:
+        up = start < index
+        up[up] = (time[up] - time[start[up]]) > window
+        if not np.any(up):
+            break
+        start[up] += 1
+
+    # segment-wise prefix sums, reset at every segment start
+    weight_prefix = np.cumsum(weights)
+    weight_prefix -= np.repeat(weight_prefix[starts[:-1]] - weights[starts[:-1]], np.diff(starts))
+    count_prefix = np.cumsum(counts)
+    count_prefix -= np.repeat(count_prefix[starts[:-1]] - counts[starts[:-1]], np.diff(starts))
+
+    before_start = start > segment_start
+    window_sum = weight_prefix.copy()
+    window_sum[before_start] -= weight_prefix[start[before_start] - 1]
+    window_count = count_prefix.copy()
+    window_count[before_start] -= count_prefix[start[before_start] - 1]
+
+    best = np.maximum.reduceat(window_sum, starts[:-1])
+    candidate = np.flatnonzero((window_sum == best[run]) & (window_sum > 0))
+    best_run, first = np.unique(run[candidate], return_index=True)
+    max_sum[best_run] = window_sum[candidate[first]]
+    max_count[best_run] = window_count[candidate[first]]
+    return max_sum, max_count
+
+
 def is_element(pid, Z):
     return (pid // 10_000) == (100000 + Z) # Returns true if the Z of the given pdg code is correct
 
-def compute_scintillator_features(scintillator_data, window_us=10):
+
+# According to CDR, this is the chance a photon hitting the PMMA being detected
+SIPM_DET_EFFICIENCY = 1.2e-3
+
+
+def compute_scintillator_features(scintillator_data, window_us=10, optical_map=None, jit=None):
     window_ns = window_us * 1e3  # convert µs → ns
+    inputs = scintillator_window_inputs(scintillator_data, optical_map)
+
+    # --- Sliding window over all events at once ---
+    with stage("sliding_window") as record:
+        max_sum, max_n_photons = sliding_window_max(inputs["starts"], inputs["time"], inputs["weighted_edep"],
+                                                    inputs["n_photons"], window_ns, jit)
+        max_sum_xenon, max_n_photons_xenon = sliding_window_max(inputs["starts"], inputs["time"],
+                                                                inputs["weighted_edep_xenon"],
+                                                                inputs["n_photons_xenon"], window_ns, jit)
+        record["rows"] = len(inputs["time"])
+        record["events"] = len(inputs["event_id"])
+
+    return pd.DataFrame({
+        "event_id": inputs["event_id"],
+        "max_10us_weighted_energy": max_sum,
+        "max_10us_weighted_energy_xenon": max_sum_xenon,
+        "max_10us_n_photons": max_n_photons * SIPM_DET_EFFICIENCY,
+        "max_10us_n_photons_xenon": max_n_photons_xenon * SIPM_DET_EFFICIENCY,
+    })
+
+
+def scintillator_window_inputs(scintillator_data, optical_map=None):
+    """
+    Everything the scintillator sliding window needs, independent of the window length: the steps
+    sorted by (evtid, time) with their weighted energies and emitted photons, and the event offsets.
+    """
+    if optical_map is None:
+        optical_map = OpticalMap()
 
     # Convert awkward arrays → flat arrays
+    with stage("scintillator_prepare") as record:
+        df = scintillator_frame(scintillator_data)
+        record["rows"] = len(df)
+
+    # Compute radius and weight
+    with stage("optical_map_weights") as record:
+        w0, w1 = optical_map.get_weighted_energy(
+            df["radius"].values,
+            df["z"].values,
+        )
+        record["rows"] = len(df)
+
+    df["weight"] = w0 / 100.0 # convert percentage to fraction
+    df["weight_xenon"] = w1 / 100.0 # convert percentage to fraction
+    df["weighted_edep"] = df["edep"] * df["weight"]
+    df["weighted_edep_xenon"] = df["edep"] * df["weight_xenon"]
+
+    # --- Sort once by (evtid, time), every event is a contiguous segment ---
+    with stage("scintillator_sort") as record:
+        df = df.iloc[np.lexsort((df["time"].values, df["evtid"].values))]
+        starts = segment_starts(df["evtid"].values)
+        evt_ids = df["evtid"].values[starts[:-1]]
+        counts = np.diff(starts)
+        record["rows"] = len(df)
+        record["events"] = len(evt_ids)
+
+    # --- Compute photons once for all events, normal and xenon weights in one jagged batch ---
+    with stage("scintillation_photons") as record:
+        weighted_edep = np.concatenate([df["weighted_edep"].values, df["weighted_edep_xenon"].values])
+        particle_id = np.tile(df["particle_id"].values, 2)
+        n_photons = emitted_scintillation_photons(ak.unflatten(weighted_edep, np.tile(counts, 2)),
+                                                  ak.unflatten(particle_id, np.tile(counts, 2)),
+                                                  "lar")
+        n_photons = ak.to_numpy(ak.flatten(n_photons))
+        n_photons, n_photons_xenon = n_photons[:len(df)], n_photons[len(df):]
+        record["rows"] = len(weighted_edep)
+
+    return {
+        "event_id": evt_ids,
+        "starts": starts,
+        "time": df["time"].values,
+        "weighted_edep": df["weighted_edep"].values,
+        "weighted_edep_xenon": df["weighted_edep_xenon"].values,
+        "n_photons": n_photons,
+        "n_photons_xenon": n_photons_xenon,
+    }
+
+
+def scintillator_frame(scintillator_data):
+    """Flat DataFrame of the scintillator steps with positions in mm and the radius"""
     evtid = ak.to_numpy(scintillator_data.evtid)
     particle_id = ak.to_numpy(scintillator_data.particle)
     x = ak.to_numpy(scintillator_data.xloc) * 1000  # mm
@@ -148,177 +617,191 @@ def compute_scintillator_features(scintillator_data, window_us=10):
         "time": time,
     })
 
-    # Compute radius and weight
     df["radius"] = np.sqrt(df["x"]**2 + df["y"]**2)
-    w0, w1 = np.vectorize(get_weighted_energy)(
-        df["radius"].values,
-        df["z"].values,
-    )
+    return df
 
-    df["weight"] = w0 / 100.0 # convert percentage to fraction
-    df["weight_xenon"] = w1 / 100.0 # convert percentage to fraction
-    df["weighted_edep"] = df["edep"] * df["weight"]
-    df["weighted_edep_xenon"] = df["edep"] * df["weight_xenon"]
+# Z of the nuclei counted in the water neutron capture count (H, Cr, Mn, Fe, Co, Ni, Mo)
+CAPTURE_NUCLEI_Z = (1, 24, 25, 26, 27, 28, 42)
+
+
+def nucleus_z(pid):
+    """Z of nuclear PDG codes (10LZZZAAAI), -1 for everything that is not a nucleus"""
+    pid = np.asarray(pid)
+    z = pid // 10_000 - 100000
+    return np.where((pid >= 1_000_000_000) & (z >= 0) & (z < 1000), z, -1)
 
-    # --- Group once ---
-    grouped = list(df.groupby("evtid", sort=False))
-    evt_ids = [evtid for evtid, _ in grouped]
-    weighted_edep_by_event = [sub["weighted_edep"].values for _, sub in grouped]
-    weighted_edep_xenon_by_event = [sub["weighted_edep_xenon"].values for _, sub in grouped]
-    particle_id_by_event = [sub["particle_id"].values for _, sub in grouped]
-    time_by_event = [sub["time"].values for _, sub in grouped]
-
-    # --- Compute photons once, event-wise ---
-    n_photons_by_event = emitted_scintillation_photons(weighted_edep_by_event,
-                                                       particle_id_by_event,
-                                                       "lar")
-    n_photons_xenon_by_event = emitted_scintillation_photons(weighted_edep_xenon_by_event,
-                                                             particle_id_by_event,
-                                                             "lar")
-
-    # --- Now process events in one loop ---
-    results = []
-    for evtid, e, e_xenon, t, n_photons, n_photons_xenon in zip(evt_ids, weighted_edep_by_event, weighted_edep_xenon_by_event, time_by_event, n_photons_by_event, n_photons_xenon_by_event):
-        # Sort by time
-        order = np.argsort(t)
-        t = t[order]
-        e = e[order]
-        e_xenon = e_xenon[order]
-        n_photons = np.asarray(n_photons)[order]
-        n_photons_xenon = np.asarray(n_photons_xenon)[order]
-
-        # Sliding window
-        max_sum = 0.0
-        max_sum_xenon = 0.0
-        max_n_photons = 0
-        max_n_photons_xenon = 0
-        n = len(t)
-        start = 0
-        current_sum = 0.0
-        current_sum_xenon = 0.0
-        current_n_photons = 0
-        current_n_photons_xenon = 0
-
-        for end in range(n):
-            current_sum += e[end]
-            current_sum_xenon += e_xenon[end]
-            current_n_photons += n_photons[end]
-            current_n_photons_xenon += n_photons_xenon[end]
-            while t[end] - t[start] > window_ns:
-                current_sum -= e[start]
-                current_sum_xenon -= e_xenon[start]
-                current_n_photons -= n_photons[start]
-                current_n_photons_xenon -= n_photons_xenon[start]
-                start += 1
-            if current_sum > max_sum:
-                max_sum = current_sum
-                max_n_photons = current_n_photons
-            if current_sum_xenon > max_sum_xenon:
-                max_sum_xenon = current_sum_xenon
-                max_n_photons_xenon = current_n_photons_xenon
-
-        # According to CDR, this is the chance a photon hitting the PMMA being detected
-        sipm_det_efficiency = 1.2e-3
-        results.append((evtid, max_sum, max_sum_xenon, max_n_photons * sipm_det_efficiency, max_n_photons_xenon * sipm_det_efficiency))
-
-
-    return pd.DataFrame(results, columns=["event_id", "max_10us_weighted_energy", "max_10us_weighted_energy_xenon", "max_10us_n_photons", "max_10us_n_photons_xenon"])
-
-def compute_track_features(tracks_data):
+
+def compute_track_features(tracks_data, capture_z=CAPTURE_NUCLEI_Z, cryo_inner_radius=3200,
+                           z_lower_straight_part=-2280, z_upper_straight_part=1720, water_tank_radius=6000):
+    """
+    Ge-77 count and number of neutron captures in the water + steel per event.
+
+    capture_z: Z of the capture nuclei counted in n_neutrons_in_ws.
+    The geometry boundaries are in mm. They are only meant to identify captures on the neutron
+    moderator and very deep inside the cryo, this is not an exact boundary check to identify
+    captures within the cryo.
+    """
     evtid = ak.to_numpy(tracks_data.evtid)
     particle_id = ak.to_numpy(tracks_data.particle)
     x = ak.to_numpy(tracks_data.xloc) * 1000  # mm
     y = ak.to_numpy(tracks_data.yloc) * 1000
     z = ak.to_numpy(tracks_data.zloc) * 1000
-
-    # These values are only to identify captures on the neutron moderator and very deep inside the cryo
-    # This is not an exact boundary check to identify captures within the cryo.
-    cryo_inner_radius = 3200 # mm
-    z_lower_straight_part = -2280 # mm
-    z_upper_straight_part = 1720 # mm
-
-    #
-    water_tank_radius = 6000 # mm
+    radius = np.sqrt(x**2 + y**2)
 
     ge77_Z = 32
     ge77_A = 77
     ge77_target_id = 100000000 + ge77_Z*1000 + ge77_A
 
-    # Define all the z-values to be counted in the water neutron capture count
-    def is_capture_nucleus(pid):
-        return (is_element(pid, 1) | is_element(pid, 24) | is_element(pid, 25) | is_element(pid, 26) |
-                is_element(pid, 27) | is_element(pid, 28) | is_element(pid, 42))
+    # lookup table Z -> counted as capture nucleus, last entry catches non-nuclei (Z = -1)
+    is_capture_z = np.zeros(1001, dtype=bool)
+    is_capture_z[list(capture_z)] = True
+    is_capture_nucleus = is_capture_z[nucleus_z(particle_id)]
 
-    df = pd.DataFrame({
-        "event_id": evtid,
-        "particle_id": particle_id,
-        "x": x,
-        "y": y,
-        "z": z,
+    in_water_or_steel = (
+        ((radius > cryo_inner_radius) | (z < z_lower_straight_part) | (z > z_upper_straight_part))
+        & (radius <= water_tank_radius)
+    )
+    is_ge77 = (particle_id // 10) == ge77_target_id
+
+    event_id, event_index = np.unique(evtid, return_inverse=True)
+    return pd.DataFrame({
+        "event_id": event_id,
+        "ge77_count": np.bincount(event_index, weights=is_ge77, minlength=len(event_id)).astype(np.int64),
+        "n_neutrons_in_ws": np.bincount(event_index, weights=is_capture_nucleus & in_water_or_steel,
+                                        minlength=len(event_id)).astype(np.int64),
     })
 
-    df["radius"] = np.sqrt(df["x"]**2 + df["y"]**2)
-    grouped = df.groupby("event_id")
-
-    def check_ge77_and_neutrons(sub):
-        ge77_count = np.sum((sub["particle_id"] // 10) == ge77_target_id)
-
-        n_neutrons = np.sum(sub["particle_id"].apply(is_capture_nucleus) &
-                            ((sub["radius"] > cryo_inner_radius) |
-                             (sub["z"] < z_lower_straight_part) |
-                             (sub["z"] > z_upper_straight_part))
-                             & (sub["radius"] <= water_tank_radius))
-        
-        return pd.Series([ge77_count, n_neutrons])
-    result = (
-        grouped.apply(check_ge77_and_neutrons, include_groups=False)
-        .reset_index()
-        .rename(columns={0: "ge77_count", 1: "n_neutrons_in_ws"})
-    )
+# Feature columns each compute_*_features function adds next to event_id
+OPTICAL_FEATURES = [
+    "il_first_us", "il_1_10_us", "il_10_200_us", "timestamp_brightest_60ns_window_1us",
+    "n_200ns_intervals_1_10_us", "mean_timestamp_intervals_1_10_us", "std_timestamp_intervals_1_10_us",
+    "n_200ns_intervals_10_200_us", "mean_timestamp_intervals_10_200_us", "std_timestamp_intervals_10_200_us",
+]
+SCINTILLATOR_FEATURES = [
+    "max_10us_weighted_energy", "max_10us_weighted_energy_xenon", "max_10us_n_photons", "max_10us_n_photons_xenon",
+]
+TRACK_FEATURES = ["ge77_count", "n_neutrons_in_ws"]
+
+
+# Value of every feature for events that do not appear in the table the feature is computed from
+MISSING_DEFAULTS = {
+    "il_first_us": np.nan,
+    "il_1_10_us": np.nan,
+    "il_10_200_us": np.nan,
+    "n_200ns_intervals_1_10_us": np.nan,
+    "n_200ns_intervals_10_200_us": np.nan,
+    "max_10us_n_photons": np.nan,
+    "max_10us_n_photons_xenon": np.nan,
+    "timestamp_brightest_60ns_window_1us": np.nan,
+    "mean_timestamp_intervals_1_10_us": np.nan,
+    "mean_timestamp_intervals_10_200_us": np.nan,
+    "std_timestamp_intervals_1_10_us": np.nan,
+    "std_timestamp_intervals_10_200_us": np.nan,
+    "max_10us_weighted_energy": np.nan,
+    "max_10us_weighted_energy_xenon": np.nan,
+    "ge77_count": np.nan,
+    "n_neutrons_in_ws": np.nan,
+}
+
+
+def align_features(event_ids, df, feature_names):
+    """
+    Place the feature columns of df at the rows of its events in the sorted event index event_ids.
+
+    Events without a row in df get the MISSING_DEFAULTS value. Columns that cover every event keep their
+    dtype, the others become float like after a pandas outer merge.
+    """
+    positions = np.searchsorted(event_ids, df["event_id"].to_numpy())
+    covers_all = len(positions) == len(event_ids)
+    aligned = {}
+    for name in feature_names:
+        values = df[name].to_numpy()
+        if covers_all:
+            aligned[name] = values[np.argsort(positions, kind="stable")]
+            continue
+        column = np.full(len(event_ids), MISSING_DEFAULTS[name], dtype=np.result_type(values.dtype, float))
+        column[positions] = values
+        aligned[name] = column
+    return aligned
+
+
+def empty_features(feature_names):
+    """Feature DataFrame without events, used for tables without any rows (e.g. in a streamed chunk)"""
+    return pd.DataFrame({
+        "event_id": np.array([], dtype=np.int64),
+        **{name: np.array([], dtype=float) for name in feature_names},
+    })
 
-    return result
 
-def convert_to_event_structure(scintillator_data, optical_data, germanium_data=None, tracks_data=None):
-    df_optical = compute_optical_features(optical_data)
+def convert_to_event_structure(scintillator_data, optical_data, germanium_data=None, tracks_data=None, optical_map=None,
+                               window_us=10, track_params=None):
+    """
+    Compute all event features and combine them into an EventTable sorted by event_id.
+
+    optical_data: the optical hits or their OpticalHistogram.
+    window_us: length of the scintillator sliding window.
+    track_params: optional keyword arguments for compute_track_features (capture Z, geometry).
+    """
+    if optical_data is not None and len(optical_data) > 0:
+        with stage("optical_features") as record:
+            if isinstance(optical_data, OpticalHistogram):
+                df_optical = compute_optical_features_from_histogram(optical_data)
+            else:
+                df_optical = compute_optical_features(optical_data)
+            record["rows"] = len(optical_data)
+            record["events"] = len(df_optical)
+    else:
+        df_optical = empty_features(OPTICAL_FEATURES)
     #df_germanium = compute_germanium_features(germanium_data)
-    df_scint = compute_scintillator_features(scintillator_data)
-    
-    # Start with optical and scintillator data
-    merged = (
-        df_optical
-        #.merge(df_germanium, on="event_id", how="outer")
-        .merge(df_scint, on="event_id", how="outer")
-    )
-    
-    # Add tracks data if available
-    if tracks_data is not None:
-        df_tracks = compute_track_features(tracks_data)
-        merged = merged.merge(df_tracks, on="event_id", how="outer")
+    if scintillator_data is not None and len(scintillator_data) > 0:
+        df_scint = compute_scintillator_features(scintillator_data, window_us=window_us, optical_map=optical_map)
     else:
-        # explicitly create the missing columns
-        merged["ge77_count"] = np.nan
-        merged["n_neutrons_in_ws"] = np.nan
+        df_scint = empty_features(SCINTILLATOR_FEATURES)
     
-    # Fill NaN values with defaults
-    merged = merged.fillna({
-        "il_first_us": np.nan,
-        "il_1_10_us": np.nan,
-        "il_10_200_us": np.nan,
-        "n_200ns_intervals_1_10_us": np.nan,
-        "n_200ns_intervals_10_200_us": np.nan,
-        "max_10us_n_photons": np.nan,
-        "max_10us_n_photons_xenon": np.nan,
-        "timestamp_brightest_60ns_window_1us": np.nan,
-        "mean_timestamp_intervals_1_10_us": np.nan,
-        "mean_timestamp_intervals_10_200_us": np.nan,
-        "std_timestamp_intervals_1_10_us": np.nan,
-        "std_timestamp_intervals_10_200_us": np.nan,
-        "max_10us_weighted_energy": np.nan,
-        "max_10us_weighted_energy_xenon": np.nan,
-        "ge77_count": np.nan,
-        "n_neutrons_in_ws": np.nan,
-    })
+    feature_frames = [(df_optical, OPTICAL_FEATURES), (df_scint, SCINTILLATOR_FEATURES)]
+    #feature_frames.append((df_germanium, GERMANIUM_FEATURES))
 
-    # Convert to dataclass list
-    events = [Event(**row) for row in merged.to_dict(orient="records")]
-    return events
+    # Add tracks data if available
+    if tracks_data is not None:
+        if len(tracks_data) > 0:
+            with stage("track_features") as record:
+                df_tracks = compute_track_features(tracks_data, **(track_params or {}))
+                record["rows"] = len(tracks_data)
+                record["events"] = len(df_tracks)
+        else:
+            df_tracks = empty_features(TRACK_FEATURES)
+        feature_frames.append((df_tracks, TRACK_FEATURES))
+
+    # One sorted event index, the union of the events of all tables
+    with stage("align_events") as record:
+        event_ids = np.unique(np.concatenate([df["event_id"].to_numpy() for df, _ in feature_frames]))
+        columns = {"event_id": event_ids}
+        for df, feature_names in feature_frames:
+            columns.update(align_features(event_ids, df, feature_names))
+
+        # columns without a producer (no tracks data) only hold the defaults
+        for name in EVENT_FIELDS[1:]:
+            if name not in columns:
+                columns[name] = np.full(len(event_ids), MISSING_DEFAULTS[name])
+        record["events"] = len(event_ids)
+
+    # Convert to columnar event table
+    return EventTable(columns)
+
+
+def iter_event_structure(chunks, optical_map=None, **feature_params):
+    """
+    Streaming version of convert_to_event_structure.
+
+    chunks: iterable of (scintillator, optical, germanium, tracks) tuples holding complete events,
+    e.g. from read_and_write.iter_event_chunks.
+    feature_params: passed on to convert_to_event_structure (window_us, track_params).
+
+    Yields:
+    The EventTable of every chunk.
+    """
+    if optical_map is None:
+        optical_map = OpticalMap()
+    for scintillator_data, optical_data, germanium_data, tracks_data in chunks:
+        yield convert_to_event_structure(scintillator_data, optical_data, germanium_data, tracks_data, optical_map,
+                                         **feature_params)
@@ -0,0 +1,144 @@
+"""
+Stage-level timing and memory instrumentation of the post-processing.
+
+    with profile_run("run008", trace_memory=True) as profiler:
+        data = read_data(...)
+        events = convert_to_event_structure(*data)
+    profiler.write_json("run008.profile.json")
+    profiler.print_summary()
+
+The pipeline functions wrap their stages in stage(), which does nothing unless a profile_run is active.
+Stages that run in worker processes (workers= / parallel_event_structure) are only seen as a whole.
+"""
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+_active = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+class Profiler:
+    """Collects one record per stage: wall time, peak RSS, tracemalloc memory and row/event counts."""
+
+    def __init__(self, name="run", trace_memory=False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.records = []
+        self.start_time = time.perf_counter()
+        self.total_seconds = None
+        self._started_tracemalloc = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage. Yields a dict to which the stage adds its counts, e.g. record["rows"] = n."""
+        record = {"stage": name}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["peak_rss_mb"] = peak_rss_mb()
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record["traced_current_mb"] = current / 1024**2
+                record["traced_peak_mb"] = peak / 1024**2
+            self.records.append(record)
+
+    def stop(self):
+        self.total_seconds = time.perf_counter() - self.start_time
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def summary(self):
+        """Records combined per stage name in order of first appearance (time and counts summed, memory maximum)"""
+        combined = {}
+        for record in self.records:
+            entry = combined.setdefault(record["stage"], {"stage": record["stage"], "calls": 0})
+            entry["calls"] += 1
+            for key, value in record.items():
+                if key == "stage" or not isinstance(value, (int, float)):
+                    continue
+                if key.endswith("_mb"):
+                    entry[key] = max(entry.get(key, 0.0), value)
+                else:
+                    entry[key] = entry.get(key, 0) + value
+        return list(combined.values())
+
+    def report(self):
+        total = self.total_seconds if self.total_seconds is not None else time.perf_counter() - self.start_time
+        return {
+            "run": self.name,
+            "total_seconds": total,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.summary(),
+            "records": self.records,
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_summary(self):
+        report = self.report()
+        print(f"Profile of {report['run']}: {report['total_seconds']:.2f} s, peak RSS {report['peak_rss_mb']:.0f} MB")
+        print(f"{'stage':<28}{'calls':>6}{'seconds':>10}{'share':>8}{'peak MB':>10}  counts")
+        for entry in report["stages"]:
+            share = entry["seconds"] / report["total_seconds"] if report["total_seconds"] else 0.0
+            peak = entry.get("traced_peak_mb", entry["peak_rss_mb"])
+            counts = ", ".join(
+                f"{key}={value}" for key, value in entry.items()
+                if key not in ("stage", "calls", "seconds") and not key.endswith("_mb")
+            )
+            print(f"{entry['stage']:<28}{entry['calls']:>6}{entry['seconds']:>10.3f}{share:>8.1%}{peak:>10.1f}  {counts}")
+
+
+@contextmanager
+def profile_run(name="run", trace_memory=False):
+    """Activate a Profiler for everything inside the with block"""
+    global _active
+    previous = _active
+    profiler = Profiler(name, trace_memory)
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = previous
+
+
+@contextmanager
+def stage(name):
+    """Record a stage in the active Profiler, without one this only yields a dict that is thrown away"""
+    if _active is None:
+        yield {}
+        return
+    with _active.stage(name) as record:
+        yield record
+
+
+def timed(name=None):
+    """Decorator version of stage(), the stage name defaults to the function name"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,12 +1,18 @@
 from lgdo import lh5
 import awkward as ak
 import csv
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from dataclasses import asdict
 import math
+import os
 import h5py
 import numpy as np
+import pandas as pd
 from dataclasses import fields
-from processing import Event
+from processing import Event, EventTable, EVENT_FIELDS, OpticalHistogram
+from profiling import stage
 
 def strip_unit(field_name):
     """Strip unit suffix of the form *_in_<unit>"""
@@ -15,161 +21,608 @@ def strip_unit(field_name):
     return field_name
 
 
-def read_lgdo_hdf5_table(file_path, table_path):
-    """Read an LGDO table from HDF5 file and return as awkward array"""
+def read_lgdo_hdf5_table(file_path, table_path, columns=None, where=None, chunk_size=None, start_row=0, n_rows=None,
+                         strings="str", dtypes=None):
+    """Read an LGDO table from HDF5 file and return as awkward array.
+    See read_lgdo_hdf5_group for the other arguments."""
     with h5py.File(file_path, 'r') as f:
-        if table_path not in f:
-            print(f"Warning. Table path {table_path} not found in file {file_path}.")
-            return None
-        
-        table_group = f[table_path]
-        data_dict = {}
-        
-        for field_name in table_group.keys():
-            field_group = table_group[field_name]
-            
-            # Skip metadata fields
-            if field_name in ['entries', 'columns', 'forms', 'names']:
-                continue
-            
-            # Strip unit suffix if present
-            clean_name = strip_unit(field_name)
-            
-            if isinstance(field_group, h5py.Group) and 'pages' in field_group:
-                pages = field_group['pages'][:]
-                
-                # Handle object dtype (strings/bytes) by converting to string
-                if pages.dtype == object or pages.dtype.kind in ('O', 'S', 'U'):
-                    # Convert bytes to strings
-                    if len(pages) > 0 and isinstance(pages[0], bytes):
-                        pages = np.array([p.decode('utf-8') if isinstance(p, bytes) else str(p) for p in pages])
-                    else:
-                        pages = pages.astype(str)
-                data_dict[clean_name] = pages
-            
-            elif isinstance(field_group, h5py.Dataset):
-                # Direct dataset
-                data = field_group[:]
-                if data.dtype == object or data.dtype.kind in ('O', 'S', 'U'):
-                    if len(data) > 0 and isinstance(data[0], bytes):
-                        data = np.array([d.decode('utf-8') if isinstance(d, bytes) else str(d) for d in data])
-                    else:
-                        data = data.astype(str)
-                data_dict[clean_name] = data
-        
-        if not data_dict:
-            print(f"Warning. No data found at table path {table_path} in file {file_path}.")
-            return None
-        
-        return ak.zip(data_dict)
+        return read_lgdo_hdf5_group(f, table_path, file_path, columns, where, chunk_size, start_row, n_rows, strings,
+                                    dtypes)
+
+
+# rows of the predicate column read at once when a where= predicate is given
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+
+def in_range(values, low, high):
+    """Row predicate low <= values <= high, use as where=(column, partial(in_range, low=..., high=...))"""
+    return (values >= low) & (values <= high)
+
+
+def in_set(values, allowed):
+    """Row predicate values in allowed, use as where=(column, partial(in_set, allowed=...))"""
+    return np.isin(values, allowed)
+
+
+# dtype policies for the loaded columns (dtypes= of the readers), columns that are not listed keep
+# their on-disk dtype. Particle ids are PDG codes (up to 10 digits for nuclei) and need int32.
+# remage times are already measured from the primary of the event, so "compact_time" stores them
+# relative to the event as float32 (about 0.03 ns resolution at 300 us).
+DTYPE_POLICIES = {
+    "full": {},
+    "compact": {
+        "xloc": np.float32,
+        "yloc": np.float32,
+        "zloc": np.float32,
+        "edep": np.float32,
+        "ekin": np.float32,
+        "evtid": np.int32,
+        "det_uid": np.int32,
+        "particle": np.int32,
+        "procid": np.int16,
+    },
+}
+DTYPE_POLICIES["compact_time"] = {**DTYPE_POLICIES["compact"], "time": np.float32}
+
+
+def dtype_policy(dtypes):
+    """dict column -> dtype for dtypes=None (on-disk dtypes), the name of a DTYPE_POLICIES entry or a dict"""
+    if dtypes is None:
+        return {}
+    if isinstance(dtypes, str):
+        if dtypes not in DTYPE_POLICIES:
+            raise ValueError(f"Unknown dtype policy {dtypes}, expected one of {list(DTYPE_POLICIES)}.")
+        return DTYPE_POLICIES[dtypes]
+    return dict(dtypes)
+
+
+def check_fits(values, dtype, name):
+    """Raise an OverflowError if integer values do not fit into dtype, NumPy would silently wrap them"""
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or values.dtype.kind not in "iu" or len(values) == 0:
+        return
+    info = np.iinfo(dtype)
+    if values.min() < info.min or values.max() > info.max:
+        raise OverflowError(f"Column {name} has values outside of the range of {dtype}.")
+
+
+def cast_columns(data, dtypes):
+    """Awkward record array with the numeric columns listed in dtypes converted, used for the lh5 reader"""
+    dtypes = dtype_policy(dtypes)
+    if data is None or not any(name in dtypes for name in ak.fields(data)):
+        return data
+    columns = {}
+    for name in ak.fields(data):
+        column = data[name]
+        if name in dtypes:
+            values = ak.to_numpy(column)
+            check_fits(values, dtypes[name], name)
+            column = values.astype(dtypes[name])
+        columns[name] = column
+    return ak.zip(columns)
+
+
+def decode_strings(data, strings="str"):
+    """Convert string columns to fixed-width NumPy strings without a Python loop over the values.
+
+    h5py returns variable length strings as object array of bytes. strings="str" decodes them to
+    unicode (dtype U), strings="bytes" keeps them as fixed-width bytes (dtype S), which is cheaper
+    for comparisons against a few known values (compare with b"name").
+    """
+    if data.dtype.kind not in ('O', 'S', 'U'):
+        return data
+    if data.dtype.kind == 'O':
+        data = data.astype(bytes) if len(data) == 0 or isinstance(data[0], bytes) else data.astype(str)
+    if strings == "str" and data.dtype.kind == 'S':
+        data = np.char.decode(data, 'utf-8')
+    elif strings == "bytes" and data.dtype.kind == 'U':
+        data = np.char.encode(data, 'utf-8')
+    return data
+
+
+def read_lgdo_hdf5_group(f, table_path, file_path=None, columns=None, where=None, chunk_size=None,
+                         start_row=0, n_rows=None, strings="str", dtypes=None):
+    """Read an LGDO table from an already opened h5py.File and return as awkward array.
+
+    columns: list of field names (without unit suffix) to read, None reads all fields.
+    where: optional row predicate (column, predicate). The column is read first in chunks of
+    chunk_size rows, predicate(values) must return a boolean mask. The other columns are only
+    read where the mask has matching rows, so rows that fail the predicate are never loaded.
+    start_row, n_rows: only read this range of rows, n_rows=None reads up to the end.
+    strings: "str" or "bytes", how string columns are returned, see decode_strings.
+    dtypes: dtype policy of the returned columns, see dtype_policy, None keeps the on-disk dtypes.
+    """
+    selection = select_lgdo_rows(f, table_path, file_path, columns, where, chunk_size, start_row, n_rows)
+    if selection is None:
+        return None
+    return selection.read(strings, dtypes)
 
 
-def read_data(output_directory, file_extension = "lh5", nr_of_threads = 16):
+def select_lgdo_rows(f, table_path, file_path=None, columns=None, where=None, chunk_size=None,
+                     start_row=0, n_rows=None):
+    """First step of read_lgdo_hdf5_group: find the fields and the rows to read, only the where column is read.
+
+    Returns a LgdoRowSelection or None if the table or the columns do not exist.
     """
-    Takes the path of where the files should be.
+    if file_path is None:
+        file_path = f.filename
 
-    nr_of_threads: number of threads used for the sim. Expects files according to "out_t{i}.lh5"
+    if table_path not in f:
+        print(f"Warning. Table path {table_path} not found in file {file_path}.")
+        return None
 
-    Returns:
-    The stp/scintillator data, the stp/optical data concatenated for all files, 
-    the stp/germanium data concatenated for all files, and the tracks data concatenated for all files.
+    table_group = f[table_path]
+    datasets = {}
+
+    for field_name in table_group.keys():
+        field_group = table_group[field_name]
+
+        # Skip metadata fields
+        if field_name in ['entries', 'columns', 'forms', 'names']:
+            continue
+
+        # Strip unit suffix if present
+        clean_name = strip_unit(field_name)
+
+        if isinstance(field_group, h5py.Group) and 'pages' in field_group:
+            datasets[clean_name] = field_group['pages']
+        elif isinstance(field_group, h5py.Dataset):
+            # Direct dataset
+            datasets[clean_name] = field_group
+
+    if columns is not None:
+        missing = [name for name in columns if name not in datasets]
+        if missing:
+            print(f"Warning. Columns {missing} not found at table path {table_path} in file {file_path}.")
+        selected = {name: datasets[name] for name in columns if name in datasets}
+    else:
+        selected = datasets
+
+    if not selected:
+        print(f"Warning. No data found at table path {table_path} in file {file_path}.")
+        return None
+
+    total_rows = next(iter(datasets.values())).shape[0]
+    end_row = total_rows if n_rows is None else min(start_row + n_rows, total_rows)
+
+    if where is not None and where[0] not in datasets:
+        raise KeyError(f"Predicate column {where[0]} not found at table path {table_path} in file {file_path}.")
+    return LgdoRowSelection(selected, datasets, where, chunk_size, start_row, end_row)
+
+
+class LgdoRowSelection:
     """
+    The rows of the columns of an LGDO table that pass a row range and an optional where predicate.
 
-    all_data = []  # list to collect the filtered arrays
-    time_min = 10.0 * 1e3  # 10 microseconds
-    time_max = 1.0 * 1e6  # 1 millisecond
-    
-    for i in range(nr_of_threads):
-        file_path = f"{output_directory}/out_t{i}.{file_extension}"
+    Creating it only reads the predicate column, so the number of selected rows (n_rows) is known
+    before any other column is loaded. read_into then copies the selected rows straight into
+    preallocated column buffers, read() allocates them for a single table.
+    """
 
-        # read file
-        if file_extension == "hdf5":
-            data = read_lgdo_hdf5_table(file_path, "stp/scintillator")
-        else:
-            data = lh5.read_as("stp/scintillator", file_path, "ak")
+    def __init__(self, selected, datasets, where=None, chunk_size=None, start_row=0, end_row=0):
+        self.selected = selected
+        # (start, stop, mask) row ranges to read, mask=None reads the whole range
+        self.spans = []
+        self.where_column = None
+        self.where_values = []
+
+        if where is None:
+            if end_row > start_row:
+                self.spans.append((start_row, end_row, None))
+            self.n_rows = max(end_row - start_row, 0)
+            return
+
+        if chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        self.where_column, predicate = where
+        where_dataset = datasets[self.where_column]
+        for start in range(start_row, end_row, chunk_size):
+            stop = min(start + chunk_size, end_row)
+            values = where_dataset[start:stop]
+            mask = np.asarray(predicate(values), dtype=bool)
+            matching = np.flatnonzero(mask)
+            if len(matching) == 0:
+                continue
 
-        # apply time cut
-        if data is not None:
-            mask = (data.time >= time_min) & (data.time <= time_max)
-            filtered_data = data[mask]
+            # only read the range of the chunk spanned by matching rows
+            first, last = matching[0], matching[-1] + 1
+            self.spans.append((start + first, start + last, mask[first:last]))
+            if self.where_column in selected:
+                # keep the already read predicate values instead of reading them again
+                self.where_values.append(values[first:last][mask[first:last]])
+        self.n_rows = sum(int(np.count_nonzero(mask)) for _, _, mask in self.spans)
+
+    def read_into(self, buffers, offset=0):
+        """Copy the selected rows of every column into buffers[name][offset:offset + n_rows]"""
+        for name, dataset in self.selected.items():
+            buffer = buffers[name]
+            position = offset
+            if name == self.where_column:
+                for values in self.where_values:
+                    check_fits(values, buffer.dtype, name)
+                    buffer[position:position + len(values)] = values
+                    position += len(values)
+                continue
+            direct = dataset.dtype.kind in "biuf" and dataset.dtype == buffer.dtype
+            for start, stop, mask in self.spans:
+                if mask is None and direct:
+                    dataset.read_direct(buffer, np.s_[start:stop], np.s_[position:position + stop - start])
+                    position += stop - start
+                else:
+                    # chunk by chunk conversion when the buffer has a different (compact) dtype
+                    values = dataset[start:stop] if mask is None else dataset[start:stop][mask]
+                    check_fits(values, buffer.dtype, name)
+                    buffer[position:position + len(values)] = values
+                    position += len(values)
+
+    def read(self, strings="str", dtypes=None):
+        buffers = allocate_buffers([self], dtypes)
+        self.read_into(buffers)
+        return ak.zip({name: decode_strings(buffer, strings) for name, buffer in buffers.items()})
+
+
+def allocate_buffers(selections, dtypes=None):
+    """One empty buffer per column, long enough for the rows of all selections (e.g. of all thread files)"""
+    dtypes = dtype_policy(dtypes)
+    n_rows = sum(selection.n_rows for selection in selections)
+    buffers = {}
+    for name in selections[0].selected:
+        disk_dtype = np.result_type(*(selection.selected[name].dtype for selection in selections))
+        dtype = dtypes[name] if name in dtypes and disk_dtype.kind in "biuf" else disk_dtype
+        buffers[name] = np.empty(n_rows, dtype=dtype)
+    return buffers
+
+
+def read_selections(selections, strings="str", dtypes=None):
+    """Read the selections of several files into one preallocated buffer per column and return as awkward array"""
+    buffers = allocate_buffers(selections, dtypes)
+    offset = 0
+    for selection in selections:
+        selection.read_into(buffers, offset)
+        offset += selection.n_rows
+    return ak.zip({name: decode_strings(buffer, strings) for name, buffer in buffers.items()})
+
+
+def concatenate_records(parts):
+    """
+    ak.concatenate for flat record arrays, but the columns are copied into preallocated buffers and
+    every part is released (set to None in the list) right after it is copied, so the data is never
+    held twice. Falls back to ak.concatenate for nested or string columns.
+    """
+    parts[:] = [part for part in parts if part is not None]
+    if not parts:
+        return None
+    try:
+        dtypes = {}
+        for part in parts:
+            for name in ak.fields(part):
+                dtypes.setdefault(name, []).append(ak.to_numpy(part[name]).dtype)
+    except ValueError:
+        # nested lists can not be converted to NumPy
+        return ak.concatenate(parts)
+    if any(dtype.kind not in "biuf" for column_dtypes in dtypes.values() for dtype in column_dtypes):
+        return ak.concatenate(parts)
+
+    n_rows = sum(len(part) for part in parts)
+    buffers = {name: np.empty(n_rows, dtype=np.result_type(*column_dtypes)) for name, column_dtypes in dtypes.items()}
+    offset = 0
+    for i, part in enumerate(parts):
+        for name, buffer in buffers.items():
+            buffer[offset:offset + len(part)] = ak.to_numpy(part[name])
+        offset += len(part)
+        parts[i] = None
+    return ak.zip(buffers)
+
+
+# All tables read_data knows about. germanium is not used by convert_to_event_structure
+# so it is not read by default.
+ALL_TABLES = ("scintillator", "optical", "germanium", "tracks")
+DEFAULT_TABLES = ("scintillator", "optical", "tracks")
+
+
+def table_path(table, file_extension):
+    """Path of a table inside the output file. The lh5 files keep tracks and processes outside of stp/."""
+    if file_extension != "hdf5" and table in ("tracks", "processes"):
+        return table
+    return f"stp/{table}"
+
+
+# Columns the feature computation in processing.py needs from every table, None reads all fields
+DEFAULT_COLUMNS = {
+    "scintillator": ["evtid", "particle", "xloc", "yloc", "zloc", "edep", "time"],
+    "optical": ["evtid", "time", "det_uid"],
+    "germanium": None,
+    "tracks": ["evtid", "particle", "procid", "xloc", "yloc", "zloc"],
+    "processes": ["name", "procid"],
+}
+
+
+def read_table(f, table, file_extension, columns=None, where=None, rows=None, dtypes=None):
+    """Read one table from an already opened output file.
+
+    rows: optional (start, stop) row range to read.
+    dtypes: dtype policy of the returned columns, see dtype_policy.
+    For lh5 files columns is passed on as field_mask and the where predicate is applied after reading.
+    """
+    start_row, n_rows = (0, None) if rows is None else (rows[0], rows[1] - rows[0])
+    if file_extension == "hdf5":
+        return read_lgdo_hdf5_group(f, table_path(table, file_extension), columns=columns, where=where,
+                                    start_row=start_row, n_rows=n_rows, dtypes=dtypes)
+
+    kwargs = {} if columns is None else {"field_mask": list(columns)}
+    if rows is not None:
+        kwargs["start_row"] = start_row
+        kwargs["n_rows"] = n_rows
+    if where is not None and columns is not None and where[0] not in columns:
+        kwargs["field_mask"].append(where[0])
+    data = lh5.read_as(table_path(table, file_extension), f, "ak", **kwargs)
+    if where is not None:
+        where_column, predicate = where
+        data = data[predicate(data[where_column])]
+        if columns is not None:
+            data = data[list(columns)]
+    return cast_columns(data, dtypes)
+
+
+# Names of the neutron capture process, older remage versions use the Geant4 name
+CAPTURE_PROCESSES = ("nCapture", "RMGnCapture")
+
+
+def read_process_ids(f, file_extension):
+    """Dict process name -> procid of the processes table of an already opened output file"""
+    processes = read_table(f, "processes", file_extension, DEFAULT_COLUMNS["processes"])
+    if processes is None:
+        return {}
+    # lh5.read_as returns the names as bytes, the hdf5 reader as str
+    names = decode_strings(np.asarray(ak.to_list(processes.name), dtype=object))
+    return dict(zip(names.tolist(), ak.to_numpy(processes.procid).tolist()))
+
+
+def process_id_array(process_ids, names=CAPTURE_PROCESSES):
+    """procids of the given process names, names missing from the file are skipped"""
+    return np.array([process_ids[name] for name in names if name in process_ids], dtype=np.int64)
+
+
+def read_thread_file(file_path, file_extension="lh5", tables=DEFAULT_TABLES,
+                     time_min=10.0 * 1e3, time_max=1.0 * 1e6, columns=None, capture_processes=CAPTURE_PROCESSES,
+                     dtypes=None):
+    """
+    Read all requested tables of a single out_t{i} file, opening the file only once.
 
-            # collect
-            all_data.append(filtered_data)
-        else:
-            print(f"No scintillator data found in file {file_path}.")
-    concatenated_scint_data = ak.concatenate(all_data)
+    The scintillator data is cut to time_min <= time <= time_max (ns) and the tracks
+    are reduced to the tracks of capture_processes (process names). Both cuts are pushed
+    down into the reader, the time/procid column is read first and only the matching rows
+    of the other columns are loaded.
+    columns: dict table name -> list of columns to read, missing tables fall back to DEFAULT_COLUMNS.
+    dtypes: dtype policy of the loaded columns, see dtype_policy.
 
-    all_data.clear()
+    Returns:
+    A dict table name -> awkward array, None for tables without data.
+    """
+    with h5py.File(file_path, 'r') as f:
+        return read_file_tables(f, file_path, file_extension, tables, time_min, time_max, columns,
+                                capture_processes=capture_processes, dtypes=dtypes)
 
-    for i in range(nr_of_threads):
-        file_path = f"{output_directory}/out_t{i}.{file_extension}"
 
-        # read file
-        if file_extension == "hdf5":
-            data = read_lgdo_hdf5_table(file_path, "stp/optical")
-        else:
-            data = lh5.read_as("stp/optical", file_path, "ak")
+def table_cut(f, file_path, file_extension, table, time_min, time_max, capture_processes=CAPTURE_PROCESSES):
+    """The where= row predicate of a table: the time cut of the scintillator, the capture procids of the tracks"""
+    if table == "scintillator":
+        return ("time", partial(in_range, low=time_min, high=time_max))
+    if table == "tracks":
+        # name -> procid once per file, the tracks are then filtered with integer comparisons
+        capture_ids = process_id_array(read_process_ids(f, file_extension), capture_processes)
+        if len(capture_ids) == 0:
+            print(f"Warning. None of the processes {list(capture_processes)} found in file {file_path}.")
+        return ("procid", partial(in_set, allowed=capture_ids))
+    return None
 
-        # collect
-        if data is not None:
-            all_data.append(data)
-        else:
-            print(f"No optical data found in file {file_path}.")
 
-    concatenated_optical_data = ak.concatenate(all_data)
+def read_file_tables(f, file_path, file_extension, tables, time_min, time_max, columns=None, rows=None,
+                     capture_processes=CAPTURE_PROCESSES, dtypes=None):
+    """
+    Read and filter the requested tables from an already opened thread file.
 
-    all_data.clear()
-    
-    for i in range(nr_of_threads):
-        file_path = f"{output_directory}/out_t{i}.{file_extension}"
+    rows: optional dict table name -> (start, stop) row range, tables not in it are read completely.
+    """
+    columns = {**DEFAULT_COLUMNS, **(columns or {})}
+    rows = rows or {}
+
+    result = {}
+    for table in tables:
+        with stage(f"read_{table}") as record:
+            try:
+                where = table_cut(f, file_path, file_extension, table, time_min, time_max, capture_processes)
+                data = read_table(f, table, file_extension, columns[table], where=where, rows=rows.get(table),
+                                  dtypes=dtypes)
+            except Exception as e:
+                if table != "tracks":
+                    raise
+                print(f"Error reading tracks from {file_path}: {e}")
+                data = None
+            record["rows"] = 0 if data is None else len(data)
+
+        if data is None:
+            print(f"No {table} data found in file {file_path}.")
+        result[table] = data
+
+    return result
+
+
+def read_hdf5_files(file_paths, tables, time_min, time_max, columns=None, capture_processes=CAPTURE_PROCESSES,
+                    dtypes=None):
+    """
+    Read the tables of all hdf5 thread files into one preallocated buffer per column.
 
-        # read file
-        if file_extension == "hdf5":
-            data = read_lgdo_hdf5_table(file_path, "stp/germanium")
-        else:
-            data = lh5.read_as("stp/germanium", file_path, "ak")
+    All files are opened once. First only the cut columns are read to get the number of selected
+    rows of every file, then every file is read straight into its slice of the buffers, so no table
+    is ever held twice (per file and concatenated).
 
-        # collect
-        if data is not None:
-            all_data.append(data)
-        else:
-            print(f"No germanium data found in file {file_path}.")
+    Returns:
+    A dict table name -> awkward array, None for tables without data.
+    """
+    columns = {**DEFAULT_COLUMNS, **(columns or {})}
+    with ExitStack() as stack:
+        files = [stack.enter_context(h5py.File(file_path, 'r')) for file_path in file_paths]
+
+        selections = {table: [] for table in tables}
+        for f, file_path in zip(files, file_paths):
+            for table in tables:
+                with stage(f"select_{table}") as record:
+                    try:
+                        where = table_cut(f, file_path, "hdf5", table, time_min, time_max, capture_processes)
+                        selection = select_lgdo_rows(f, table_path(table, "hdf5"), file_path, columns[table], where)
+                    except Exception as e:
+                        if table != "tracks":
+                            raise
+                        print(f"Error reading tracks from {file_path}: {e}")
+                        selection = None
+                    record["rows"] = 0 if selection is None else selection.n_rows
+                if selection is None:
+                    print(f"No {table} data found in file {file_path}.")
+                else:
+                    selections[table].append(selection)
 
-    concatenated_germanium_data = ak.concatenate(all_data)
+        result = {}
+        for table, table_selections in selections.items():
+            if not table_selections:
+                result[table] = None
+                continue
+            with stage(f"read_{table}") as record:
+                result[table] = read_selections(table_selections, dtypes=dtypes)
+                record["rows"] = len(result[table])
+    return result
 
-    all_data.clear()
-    
-    for i in range(nr_of_threads):
-        file_path = f"{output_directory}/out_t{i}.{file_extension}"
 
-        # read file
-        try:
-            if file_extension == "hdf5":
-                data = read_lgdo_hdf5_table(file_path, "stp/tracks")
-                processes = read_lgdo_hdf5_table(file_path, "stp/processes")
-            else:
-                data = lh5.read_as("tracks", file_path, "ak")
-                processes = lh5.read_as("processes", file_path, "ak")
-
-            allowed_processes = (processes.name == "nCapture") | (processes.name == "RMGnCapture")
-            proc_id = processes.procid[allowed_processes]
-            track_mask = data.procid == proc_id
-            data = data[track_mask]
-        except Exception as e:
-            print(f"Error reading tracks from {file_path}: {e}")
-            
+def read_data(output_directory, file_extension = "lh5", nr_of_threads = 16, tables = DEFAULT_TABLES, workers = None, columns = None,
+              capture_processes = CAPTURE_PROCESSES, time_min = 10.0 * 1e3, time_max = 1.0 * 1e6, dtypes = None):
+    """
+    Takes the path of where the files should be.
 
+    nr_of_threads: number of threads used for the sim. Expects files according to "out_t{i}.lh5"
+    tables: which of "scintillator", "optical", "germanium" and "tracks" to read. Every file is
+    opened once and all requested tables are read in that visit.
+    workers: if > 1, read and filter the thread files in parallel in a pool of this many processes.
+    The result is concatenated in thread order, identical to the serial read.
+    columns: dict table name -> list of columns to read, by default only the columns processing.py uses.
+    capture_processes: process names whose tracks are kept, by default nCapture and RMGnCapture.
+    time_min, time_max: time cut (ns) of the scintillator data.
+    dtypes: dtype policy of the loaded columns, e.g. "compact" (float32 positions and energies,
+    int32 event and detector ids), see DTYPE_POLICIES. None keeps the on-disk dtypes.
+    The hdf5 files are read straight into one preallocated buffer per column (read_hdf5_files),
+    otherwise the per file results are copied into such buffers one by one (concatenate_records).
+
+    Returns:
+    The stp/scintillator data, the stp/optical data concatenated for all files, 
+    the stp/germanium data concatenated for all files, and the tracks data concatenated for all files.
+    Tables that were not requested are returned as None.
+    """
+    unknown = set(tables) - set(ALL_TABLES)
+    if unknown:
+        raise ValueError(f"Unknown tables {sorted(unknown)}, expected some of {ALL_TABLES}.")
+
+    file_paths = [f"{output_directory}/out_t{i}.{file_extension}" for i in range(nr_of_threads)]
+
+    if file_extension == "hdf5" and not (workers is not None and workers > 1):
+        concatenated = read_hdf5_files(file_paths, tables, time_min, time_max, columns, capture_processes, dtypes)
+        return tuple(concatenated.get(table) for table in ALL_TABLES)
+
+    all_data = {table: [] for table in tables}
+    if workers is not None and workers > 1:
+        # executor.map keeps the order of the thread files
+        with stage("read_files_parallel") as record, ProcessPoolExecutor(max_workers=min(workers, nr_of_threads)) as executor:
+            read_file = partial(read_thread_file, file_extension=file_extension, tables=tables, time_min=time_min,
+                                time_max=time_max, columns=columns, capture_processes=capture_processes, dtypes=dtypes)
+            per_file_data = list(executor.map(read_file, file_paths))
+            record["files"] = len(file_paths)
+    else:
+        per_file_data = (read_thread_file(file_path, file_extension, tables, time_min, time_max, columns,
+                                          capture_processes, dtypes)
+                         for file_path in file_paths)
+
+    for file_data in per_file_data:
         # collect
-        if data is not None:
-            all_data.append(data)
-        else:
-            print(f"No tracks data found in file {file_path}.")
+        for table, data in file_data.items():
+            if data is not None:
+                all_data[table].append(data)
+    del per_file_data
+
+    with stage("concatenate") as record:
+        concatenated = {
+            table: concatenate_records(all_data[table]) if all_data.get(table) else None
+            for table in ALL_TABLES
+        }
+        record["rows"] = sum(len(data) for data in concatenated.values() if data is not None)
+
+    return concatenated["scintillator"], concatenated["optical"], concatenated["germanium"], concatenated["tracks"]
+
+def iter_event_chunks(output_directory, file_extension = "lh5", nr_of_threads = 16, events_per_chunk = 10_000,
+                      tables = DEFAULT_TABLES, columns = None, time_min = 10.0 * 1e3, time_max = 1.0 * 1e6, dtypes = None):
+    """
+    Stream the thread files in chunks of complete events instead of loading everything at once.
 
-    concatenated_tracks_data = ak.concatenate(all_data)
+    Every thread file is split into ranges of at most events_per_chunk event ids, using the union of the
+    evtids of all requested tables, and the same range is read from every table. No event is split
+    between chunks. Only the evtid columns of one file are held in memory next to the current chunk.
 
-    return concatenated_scint_data, concatenated_optical_data, concatenated_germanium_data, concatenated_tracks_data
+    Yields:
+    (scintillator, optical, germanium, tracks) with the same filtering and dtypes as read_data, per chunk.
+    Tables that were not requested are None. Chunks come in thread file order, not globally sorted by evtid.
+    """
+    unknown = set(tables) - set(ALL_TABLES)
+    if unknown:
+        raise ValueError(f"Unknown tables {sorted(unknown)}, expected some of {ALL_TABLES}.")
 
-def write_events_to_csv(events, filename):
+    for i in range(nr_of_threads):
+        file_path = f"{output_directory}/out_t{i}.{file_extension}"
+
+        with h5py.File(file_path, 'r') as f:
+            evtids = {}
+            presorted = {}
+            for table in tables:
+                data = read_table(f, table, file_extension, ["evtid"])
+                if data is None:
+                    print(f"No {table} data found in file {file_path}.")
+                    continue
+                evtid = ak.to_numpy(data.evtid)
+
+                if np.any(np.diff(evtid) < 0):
+                    # rows are not ordered by event, read this table once and sort it in memory
+                    print(f"Warning. {table} in {file_path} is not sorted by evtid, reading it completely.")
+                    table_data = read_file_tables(f, file_path, file_extension, [table], time_min, time_max, columns,
+                                                  dtypes=dtypes)[table]
+                    if table_data is None:
+                        continue
+                    order = np.argsort(ak.to_numpy(table_data.evtid), kind="stable")
+                    presorted[table] = table_data[order]
+                    evtid = ak.to_numpy(presorted[table].evtid)
+                evtids[table] = evtid
+
+            if not evtids:
+                continue
+            event_ids = np.unique(np.concatenate(list(evtids.values())))
+            chunk_starts = event_ids[::events_per_chunk]
+
+            for k, low in enumerate(chunk_starts):
+                high = chunk_starts[k + 1] if k + 1 < len(chunk_starts) else None
+                rows = {}
+                for table, evtid in evtids.items():
+                    start = np.searchsorted(evtid, low, side="left")
+                    stop = len(evtid) if high is None else np.searchsorted(evtid, high, side="left")
+                    rows[table] = (int(start), int(stop))
+
+                on_disk = [table for table in evtids if table not in presorted]
+                chunk = read_file_tables(f, file_path, file_extension, on_disk, time_min, time_max, columns, rows,
+                                         dtypes=dtypes)
+                for table, table_data in presorted.items():
+                    start, stop = rows[table]
+                    chunk[table] = table_data[start:stop]
+
+                yield tuple(chunk.get(table) for table in ALL_TABLES)
+
+
+def write_events_to_csv(events, filename, append=False):
+    """Write the events to a csv file. With append=True the events are added to an existing
+    file (the header is only written if the file is new), e.g. for the chunks of iter_event_structure."""
     if not events:
         print("No events to write.")
         return
@@ -177,11 +630,14 @@ def write_events_to_csv(events, filename):
     # Use the dataclass fields as column names
     fieldnames = list(asdict(events[0]).keys())
 
-    with open(filename, "w", newline="") as f:
+    write_header = not (append and os.path.exists(filename) and os.path.getsize(filename) > 0)
+    with stage("write_csv") as record, open(filename, "a" if append else "w", newline="") as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+        if write_header:
+            writer.writeheader()
         for ev in events:
             writer.writerow(asdict(ev))
+        record["events"] = len(events)
 
 
 def read_events_from_csv(filename):
@@ -224,4 +680,120 @@ def read_events_from_csv(filename):
 
             events.append(Event(**converted))
 
-    return events
\ No newline at end of file
+    return events
+
+
+def apply_event_schema(columns):
+    """
+    Cast event columns to the types of the Event fields with the conventions of read_events_from_csv:
+    int fields become int64 with NaN -> 0 (truncating like int(float(value))), float fields become float64.
+    """
+    typed = {}
+    for field in fields(Event):
+        column = np.asarray(columns[field.name])
+        if field.type is int:
+            column = column.astype(float)
+            typed[field.name] = np.where(np.isnan(column), 0, column).astype(np.int64)
+        elif field.type is float:
+            typed[field.name] = column.astype(np.float64)
+        else:
+            typed[field.name] = column
+    return typed
+
+
+def event_file_format(filename, file_format=None):
+    """File format from the file extension: "hdf5" (.h5, .hdf5), "parquet" or "csv".
+    .lh5 is not accepted, the events group is plain HDF5 and not an LGDO table."""
+    if file_format is not None:
+        return file_format
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".h5", ".hdf5"):
+        return "hdf5"
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    if extension == ".csv":
+        return "csv"
+    raise ValueError(f"Can not determine the event file format of {filename}, pass file_format.")
+
+
+def write_events(events, filename, file_format=None, compression="gzip", apply_schema=True):
+    """
+    Write events (EventTable or list of Event) to a columnar file, the format follows the file
+    extension unless file_format is given:
+    - "hdf5": one compressed dataset per Event field in the group "events"
+    - "parquet": needs pyarrow
+    - "csv": write_events_to_csv
+    The columns are stored with the types of the Event fields, see apply_event_schema.
+    With apply_schema=False they are stored as they are (e.g. NaN in int fields), not for csv.
+    """
+    file_format = event_file_format(filename, file_format)
+    if file_format == "csv":
+        write_events_to_csv(events, filename)
+        return
+
+    if not isinstance(events, EventTable):
+        events = EventTable.from_events(events)
+    columns = apply_event_schema(events.columns) if apply_schema else events.columns
+
+    with stage(f"write_{file_format}") as record:
+        if file_format == "hdf5":
+            with h5py.File(filename, "w") as f:
+                group = f.create_group("events")
+                for name, column in columns.items():
+                    group.create_dataset(name, data=column, compression=compression,
+                                         shuffle=compression is not None)
+        elif file_format == "parquet":
+            # pandas raises an ImportError naming pyarrow if it is not installed
+            pd.DataFrame(columns).to_parquet(filename, compression=compression)
+        else:
+            raise ValueError(f"Unknown event file format {file_format}.")
+        record["events"] = len(events)
+
+
+def read_events(filename, file_format=None, apply_schema=True):
+    """Read events written by write_events (or a csv of write_events_to_csv) into an EventTable.
+    With apply_schema=False the columns are returned as stored."""
+    file_format = event_file_format(filename, file_format)
+
+    if file_format == "hdf5":
+        with h5py.File(filename, "r") as f:
+            columns = {name: f["events"][name][:] for name in EVENT_FIELDS}
+    elif file_format == "parquet":
+        df = pd.read_parquet(filename, columns=EVENT_FIELDS)
+        columns = {name: df[name].to_numpy() for name in EVENT_FIELDS}
+    elif file_format == "csv":
+        df = pd.read_csv(filename, float_precision="round_trip")
+        columns = {name: df[name].to_numpy() for name in EVENT_FIELDS}
+    else:
+        raise ValueError(f"Unknown event file format {file_format}.")
+
+    return EventTable(apply_event_schema(columns) if apply_schema else columns)
+
+
+# arrays of an OpticalHistogram as stored by write_optical_histogram
+OPTICAL_HISTOGRAM_ARRAYS = ("event_id", "offsets", "time_bin", "det_uid", "count", "prompt_offsets", "prompt_time")
+
+
+def write_optical_histogram(histogram, filename, compression="gzip", attrs=None):
+    """Write an OpticalHistogram to the group "optical_histogram" of an HDF5 file, every array compressed.
+    attrs: optional extra attributes, e.g. what the histogram was built from."""
+    with stage("write_optical_histogram") as record, h5py.File(filename, "w") as f:
+        group = f.create_group("optical_histogram")
+        group.attrs["bin_width"] = histogram.bin_width
+        group.attrs["prompt_window"] = histogram.prompt_window
+        for key, value in (attrs or {}).items():
+            group.attrs[key] = value
+        for name in OPTICAL_HISTOGRAM_ARRAYS:
+            group.create_dataset(name, data=getattr(histogram, name), compression=compression,
+                                 shuffle=compression is not None)
+        record["events"] = len(histogram)
+
+
+def read_optical_histogram(filename):
+    """Read an OpticalHistogram written by write_optical_histogram"""
+    with stage("read_optical_histogram") as record, h5py.File(filename, "r") as f:
+        group = f["optical_histogram"]
+        histogram = OpticalHistogram(*(group[name][:] for name in OPTICAL_HISTOGRAM_ARRAYS),
+                                     bin_width=group.attrs["bin_width"], prompt_window=group.attrs["prompt_window"])
+        record["events"] = len(histogram)
+    return histogram
@@ -0,0 +1,121 @@
+"""
+Batch post-processing of several runs without the notebook.
+
+Example:
+    python run_post_proc.py data/optics_run8 data/optics_run7 --file-extension hdf5 --jobs 2
+
+Every run directory is processed with read_data + convert_to_event_structure and written to
+<output-dir>/results_<run name>.<format>. Runs whose result is newer than all of their thread files
+and optical map files are skipped unless --force is given. The exit code is 1 if any run failed.
+"""
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from processing import convert_to_event_structure
+from profiling import profile_run
+from read_and_write import read_data, write_events, DTYPE_POLICIES
+from weights import OpticalMap
+
+
+def output_path(run_directory, output_dir, file_format):
+    run_name = os.path.basename(os.path.normpath(run_directory))
+    return os.path.join(output_dir, f"results_{run_name}.{file_format}")
+
+
+def input_files(run_directory, file_extension, nr_of_threads, map_dir):
+    return [f"{run_directory}/out_t{i}.{file_extension}" for i in range(nr_of_threads)] + OpticalMap.source_files_in(map_dir)
+
+
+def is_up_to_date(result_path, inputs):
+    """True if the result exists and is newer than every existing input file"""
+    if not os.path.exists(result_path):
+        return False
+    result_mtime = os.path.getmtime(result_path)
+    return all(os.path.getmtime(path) <= result_mtime for path in inputs if os.path.exists(path))
+
+
+def profile_path(result_path):
+    return os.path.splitext(result_path)[0] + ".profile.json"
+
+
+def process_run(run_directory, result_path, file_extension, nr_of_threads, map_dir, workers, profile=False,
+                dtypes=None):
+    """Process a single run and write its result, returns the number of events"""
+    run_name = os.path.basename(os.path.normpath(run_directory))
+    with profile_run(run_name, trace_memory=profile) as profiler:
+        scint_data, optical_data, germanium_data, tracks_data = read_data(
+            run_directory, file_extension=file_extension, nr_of_threads=nr_of_threads, workers=workers, dtypes=dtypes
+        )
+        events = convert_to_event_structure(scint_data, optical_data, germanium_data, tracks_data,
+                                            optical_map=OpticalMap(map_dir))
+        os.makedirs(os.path.dirname(result_path) or ".", exist_ok=True)
+        write_events(events, result_path)
+    if profile:
+        profiler.write_json(profile_path(result_path))
+        profiler.print_summary()
+    return len(events)
+
+
+def timed_process_run(*args):
+    """process_run for the process pool: never raises, returns (n_events, seconds, error)"""
+    start = time.perf_counter()
+    try:
+        n_events = process_run(*args)
+        return n_events, time.perf_counter() - start, None
+    except Exception:
+        return None, time.perf_counter() - start, traceback.format_exc()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Post-process remage runs into event tables.")
+    parser.add_argument("runs", nargs="+", help="run directories containing out_t{i}.<ext> files")
+    parser.add_argument("--file-extension", default="lh5", choices=["lh5", "hdf5"], help="extension of the thread files")
+    parser.add_argument("--threads", type=int, default=16, help="number of thread files per run")
+    parser.add_argument("--jobs", type=int, default=1, help="number of runs processed concurrently")
+    parser.add_argument("--read-workers", type=int, default=None, help="processes reading the thread files of a run")
+    parser.add_argument("--output-dir", default=".", help="directory the result tables are written to")
+    parser.add_argument("--format", default="csv", choices=["csv", "h5", "parquet"], help="format of the result tables")
+    parser.add_argument("--map-dir", default="./1d_map", help="directory of the 1d optical map json files")
+    parser.add_argument("--force", action="store_true", help="process runs even if their result is up to date")
+    parser.add_argument("--dtypes", default="full", choices=list(DTYPE_POLICIES),
+                        help="dtype policy of the loaded tables, compact halves the memory of most columns")
+    parser.add_argument("--profile", action="store_true",
+                        help="write per stage time and memory to results_<run name>.profile.json")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for run_directory in args.runs:
+        result_path = output_path(run_directory, args.output_dir, args.format)
+        inputs = input_files(run_directory, args.file_extension, args.threads, args.map_dir)
+        if not args.force and is_up_to_date(result_path, inputs):
+            print(f"{run_directory}: skipped, {result_path} is up to date")
+            continue
+        jobs.append((run_directory, result_path))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs) or 1))) as executor:
+        futures = [
+            executor.submit(timed_process_run, run_directory, result_path, args.file_extension,
+                            args.threads, args.map_dir, args.read_workers, args.profile, args.dtypes)
+            for run_directory, result_path in jobs
+        ]
+        for (run_directory, result_path), future in zip(jobs, futures):
+            n_events, seconds, error = future.result()
+            if error is None:
+                print(f"{run_directory}: {n_events} events written to {result_path} in {seconds:.1f} s")
+            else:
+                print(f"{run_directory}: failed after {seconds:.1f} s\n{error}", file=sys.stderr)
+                failed.append(run_directory)
+
+    if failed:
+        print(f"{len(failed)} of {len(args.runs)} runs failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
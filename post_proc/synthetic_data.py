@@ -0,0 +1,236 @@
+"""
+Synthetic remage output and optical map for benchmarking without the real (confidential) data.
+
+Example:
+    python synthetic_data.py data/synthetic --threads 4 --events 1000 --map-dir synthetic_1d_map
+
+The thread files out_t{i}.hdf5 use the LGDO layout read_lgdo_hdf5_table expects: one group per
+table under stp/, one group <field>_in_<unit> with a pages dataset per column and an entries
+dataset. With --file-extension lh5 the files out_t{i}.lh5 are written with lgdo like the lh5 remage
+output instead (tracks and processes outside of stp/, units as attributes). Event ids are interleaved over the threads like in a multi-threaded remage run, so every
+event lives in exactly one thread file. The same seed always gives the same files.
+"""
+import argparse
+import json
+import os
+
+import h5py
+import numpy as np
+from lgdo import lh5, Array, Table
+
+from read_and_write import table_path
+from weights import MAP_ZONES
+
+# mean number of rows per event of every table
+DEFAULT_DENSITY = {
+    "scintillator": 20,
+    "optical": 150,
+    "germanium": 2,
+    "tracks": 15,
+}
+
+# remage registers either nCapture (older versions) or RMGnCapture
+PROCESS_NAMES = ["Transportation", "RMGnCapture", "hIoni", "eIoni", "compt", "msc"]
+
+# particles of the tracks table, neutrons, gammas and the nuclei of the track features
+TRACK_PARTICLES = [2112, 22, 1000010020, 1000260570, 1000320770, 1000320771, 1000420980, 1000080170]
+SCINTILLATOR_PARTICLES = [11, 22, 2112, 1000020040]
+
+
+def write_lgdo_table(f, table_path, columns, units=None):
+    """Write a dict name -> array as LGDO table, columns with a unit get the _in_<unit> suffix"""
+    units = units or {}
+    group = f.create_group(table_path)
+    n_rows = len(next(iter(columns.values())))
+    field_names = [f"{name}_in_{units[name]}" if name in units else name for name in columns]
+    group.attrs["datatype"] = "table{" + ",".join(field_names) + "}"
+    group.create_dataset("entries", data=np.int64(n_rows))
+    for field_name, (name, values) in zip(field_names, columns.items()):
+        field_group = group.create_group(field_name)
+        if values.dtype.kind in "OSU":
+            field_group.attrs["datatype"] = "array<1>{string}"
+            field_group.create_dataset("pages", data=values.astype(object), dtype=h5py.string_dtype())
+        else:
+            field_group.attrs["datatype"] = "array<1>{real}"
+            field_group.create_dataset("pages", data=values)
+        if name in units:
+            field_group.attrs["units"] = units[name]
+
+
+def write_lh5_table(file_path, table_path, columns, units=None):
+    """Write a dict name -> array as lgdo Table, strings as fixed-width bytes like remage"""
+    units = units or {}
+    col_dict = {}
+    for name, values in columns.items():
+        if values.dtype.kind in "OU":
+            values = values.astype(bytes)
+        col_dict[name] = Array(values, attrs={"units": units[name]} if name in units else None)
+    lh5.write(Table(col_dict=col_dict), table_path, file_path, wo_mode="append")
+
+
+def rows_per_event(rng, n_events, density):
+    """Poisson distributed number of rows for every event"""
+    return rng.poisson(density, n_events)
+
+
+def scintillator_table(rng, event_ids, density):
+    evtid = np.repeat(event_ids, rows_per_event(rng, len(event_ids), density))
+    n = len(evtid)
+    # steps in and around the moderator (radius up to 1.82 m, z between -2.9 m and 0.3 m) and in the argon outside
+    radius = np.sqrt(rng.uniform(0, 3.0**2, n))
+    phi = rng.uniform(0, 2 * np.pi, n)
+    columns = {
+        "evtid": evtid,
+        "particle": rng.choice(SCINTILLATOR_PARTICLES, n),
+        "xloc": radius * np.cos(phi),
+        "yloc": radius * np.sin(phi),
+        "zloc": rng.uniform(-3.8, 1.2, n),
+        "edep": rng.exponential(50, n),
+        # prompt muon steps, delayed neutron captures up to 2 ms
+        "time": np.exp(rng.uniform(0, np.log(2e6), n)),
+    }
+    units = {"xloc": "m", "yloc": "m", "zloc": "m", "edep": "keV", "time": "ns"}
+    return columns, units
+
+
+def optical_table(rng, event_ids, density, n_detectors=20):
+    counts = rows_per_event(rng, len(event_ids), density)
+    evtid = np.repeat(event_ids, counts)
+    n = len(evtid)
+    # 40 % of the hits in the prompt muon flash, 40 % in a delayed flash (e.g. a neutron capture)
+    # decaying with the argon triplet lifetime and 20 % log-uniform background up to 300 us
+    capture_time = np.repeat(np.exp(rng.uniform(np.log(1e3), np.log(2e5), len(event_ids))), counts)
+    component = rng.random(n)
+    time = np.where(component < 0.4, rng.uniform(0, 1e3, n),
+                    np.where(component < 0.8, capture_time + rng.exponential(1300, n),
+                             np.exp(rng.uniform(np.log(1e3), np.log(3e5), n))))
+    columns = {
+        "evtid": evtid,
+        "time": time,
+        "det_uid": rng.integers(0, n_detectors, n),
+    }
+    return columns, {"time": "ns"}
+
+
+def germanium_table(rng, event_ids, density, n_detectors=10):
+    evtid = np.repeat(event_ids, rows_per_event(rng, len(event_ids), density))
+    n = len(evtid)
+    columns = {
+        "evtid": evtid,
+        "edep": rng.exponential(100, n),
+        "det_uid": rng.integers(0, n_detectors, n),
+    }
+    return columns, {"edep": "keV"}
+
+
+def tracks_table(rng, event_ids, density):
+    evtid = np.repeat(event_ids, rows_per_event(rng, len(event_ids), density))
+    n = len(evtid)
+    columns = {
+        "evtid": evtid,
+        "particle": rng.choice(TRACK_PARTICLES, n),
+        "procid": rng.integers(0, len(PROCESS_NAMES), n),
+        "trackid": np.arange(n),
+        # water tank with radius 6 m, height -6 m to 6 m
+        "xloc": rng.uniform(-6.5, 6.5, n),
+        "yloc": rng.uniform(-6.5, 6.5, n),
+        "zloc": rng.uniform(-6, 6, n),
+        "ekin": rng.exponential(100, n),
+    }
+    units = {"xloc": "m", "yloc": "m", "zloc": "m", "ekin": "keV"}
+    return columns, units
+
+
+def processes_table():
+    return {"name": np.array(PROCESS_NAMES, dtype=object), "procid": np.arange(len(PROCESS_NAMES))}, {}
+
+
+TABLE_GENERATORS = {
+    "scintillator": scintillator_table,
+    "optical": optical_table,
+    "germanium": germanium_table,
+    "tracks": tracks_table,
+}
+
+
+def write_thread_files(output_directory, nr_of_threads=4, events_per_thread=1000, density=None, seed=0,
+                       file_extension="hdf5"):
+    """
+    Write out_t{i}.<file_extension> for i in range(nr_of_threads) and return their paths.
+
+    density: dict table name -> mean rows per event, missing tables use DEFAULT_DENSITY.
+    file_extension: "hdf5" or "lh5", both hold the same data for the same seed.
+    """
+    if file_extension not in ("hdf5", "lh5"):
+        raise ValueError(f"Unknown file extension {file_extension}, expected 'hdf5' or 'lh5'.")
+    density = {**DEFAULT_DENSITY, **(density or {})}
+    os.makedirs(output_directory, exist_ok=True)
+    file_paths = []
+    for thread in range(nr_of_threads):
+        # one independent stream per thread, the files do not depend on the number of threads written before
+        rng = np.random.default_rng([seed, thread])
+        event_ids = np.arange(thread, events_per_thread * nr_of_threads, nr_of_threads)
+        file_path = f"{output_directory}/out_t{thread}.{file_extension}"
+        tables = [(table, *generator(rng, event_ids, density[table])) for table, generator in TABLE_GENERATORS.items()]
+        tables.append(("processes", *processes_table()))
+        if file_extension == "hdf5":
+            with h5py.File(file_path, "w") as f:
+                for table, columns, units in tables:
+                    write_lgdo_table(f, table_path(table, file_extension), columns, units)
+        else:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            for table, columns, units in tables:
+                write_lh5_table(file_path, table_path(table, file_extension), columns, units)
+        file_paths.append(file_path)
+    return file_paths
+
+
+# coordinate range of every map zone in map coordinates (cm, weights.py looks up (r + SHIFT_R) / 10 with r in mm),
+# covering the adjusted coordinates of the generated scintillator steps (r 0 to 300, z -308 to 192)
+MAP_RANGES = {
+    "R": (0, 350),
+    "z": (-300, 200),
+}
+
+
+def write_optical_map(map_dir, n_points=100, seed=0):
+    """Write a smooth synthetic 1d optical map (normal and _xenon json per zone) and return the file paths"""
+    os.makedirs(map_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    file_paths = []
+    for zone, coord in MAP_ZONES.items():
+        low, high = MAP_RANGES[coord]
+        x = np.linspace(low, high, n_points)
+        for suffix, scale in (("", 1.0), ("_xenon", 1.3)):
+            # a detection probability peak in % somewhere inside the zone on a flat background
+            center = rng.uniform(low, high)
+            width = rng.uniform(0.1, 0.4) * (high - low)
+            prob = scale * (0.2 + rng.uniform(1, 4) * np.exp(-0.5 * ((x - center) / width) ** 2))
+            file_path = f"{map_dir}/{zone}{suffix}.json"
+            with open(file_path, "w") as f:
+                json.dump({coord: x.tolist(), "prob": prob.tolist()}, f)
+            file_paths.append(file_path)
+    return file_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic remage thread files and a synthetic 1d optical map.")
+    parser.add_argument("output_directory", help="directory the out_t{i}.hdf5 files are written to")
+    parser.add_argument("--threads", type=int, default=4, help="number of thread files")
+    parser.add_argument("--events", type=int, default=1000, help="events per thread file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--file-extension", default="hdf5", choices=["hdf5", "lh5"], help="layout of the thread files")
+    parser.add_argument("--map-dir", default=None, help="also write a synthetic optical map to this directory")
+    for table, value in DEFAULT_DENSITY.items():
+        parser.add_argument(f"--{table}-density", type=float, default=value, help=f"mean {table} rows per event")
+    args = parser.parse_args(argv)
+
+    density = {table: getattr(args, f"{table}_density") for table in DEFAULT_DENSITY}
+    write_thread_files(args.output_directory, args.threads, args.events, density, args.seed, args.file_extension)
+    if args.map_dir is not None:
+        write_optical_map(args.map_dir, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Ge-77 tagging efficiency and dead time of the muon veto for a whole grid of thresholds.
+
+    events, weights = combine_runs([run7, run8], [w7, w8])
+    surface = veto_surface(events, np.arange(0, 200, 5), np.arange(0, 30), weights=weights)
+    surface.working_point(min_efficiency=0.9)
+
+An event is vetoed by the argon veto if its argon feature is >= the argon threshold and by the
+water veto if its neutron feature is >= the neutron threshold, logic="or"/"and" combines the two.
+Events without a feature (NaN) are never vetoed by it.
+"""
+import numpy as np
+import pandas as pd
+
+from processing import EventTable
+
+ARGON_FEATURE = "max_10us_n_photons"
+NEUTRON_FEATURE = "n_200ns_intervals_10_200_us"
+
+
+def combine_runs(tables, weights):
+    """
+    Concatenate the EventTables of several runs and give every event the weight of its run,
+    e.g. to normalize a Ge-77 only run (run008) and an all muons run (run007) to the same live time.
+
+    Returns:
+    The combined EventTable and the weight of every event.
+    """
+    tables = list(tables)
+    weights = list(weights)
+    if len(tables) != len(weights):
+        raise ValueError(f"Got {len(tables)} runs but {len(weights)} weights.")
+    event_weights = np.concatenate([np.full(len(table), weight, dtype=float) for table, weight in zip(tables, weights)])
+    return EventTable.concatenate(tables), event_weights
+
+
+def threshold_index(values, thresholds):
+    """Number of thresholds <= value for every value, NaN gives 0 (below every threshold)"""
+    values = np.asarray(values, dtype=float)
+    return np.searchsorted(thresholds, np.where(np.isnan(values), -np.inf, values), side="right")
+
+
+def vetoed_above(argon_index, neutron_index, weights, n_argon, n_neutron):
+    """
+    Weighted number of events with argon >= argon_thresholds[i] and neutron >= neutron_thresholds[j]
+    for all i, j at once: a 2D histogram of the threshold indices summed from the top in both axes.
+
+    Returns an (n_argon + 1, n_neutron + 1) array, entry [i + 1, j + 1] holds the pair (i, j),
+    row 0 / column 0 are the events without a condition on argon / neutrons.
+    """
+    histogram = np.bincount(argon_index * (n_neutron + 1) + neutron_index, weights=weights,
+                            minlength=(n_argon + 1) * (n_neutron + 1)).reshape(n_argon + 1, n_neutron + 1)
+    return histogram[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+
+
+class VetoSurface:
+    """
+    Veto performance on a grid of thresholds, arrays of shape (len(argon_thresholds), len(neutron_thresholds)):
+    efficiency: weighted fraction of the Ge-77 events (ge77_count > 0) that are vetoed.
+    dead_fraction: weighted fraction of the other muon events that are vetoed.
+    """
+
+    def __init__(self, argon_thresholds, neutron_thresholds, efficiency, dead_fraction, n_ge77, n_other, logic):
+        self.argon_thresholds = argon_thresholds
+        self.neutron_thresholds = neutron_thresholds
+        self.efficiency = efficiency
+        self.dead_fraction = dead_fraction
+        self.n_ge77 = n_ge77
+        self.n_other = n_other
+        self.logic = logic
+
+    def at(self, argon_threshold, neutron_threshold):
+        """(efficiency, dead_fraction) of one threshold pair of the grid"""
+        i = np.flatnonzero(np.isclose(self.argon_thresholds, argon_threshold))
+        j = np.flatnonzero(np.isclose(self.neutron_thresholds, neutron_threshold))
+        if len(i) == 0 or len(j) == 0:
+            raise KeyError(f"({argon_threshold}, {neutron_threshold}) is not on the threshold grid.")
+        return self.efficiency[i[0], j[0]], self.dead_fraction[i[0], j[0]]
+
+    def working_point(self, min_efficiency):
+        """Threshold pair with the smallest dead fraction among those with efficiency >= min_efficiency,
+        ties go to the higher efficiency. None if no pair reaches min_efficiency."""
+        allowed = self.efficiency >= min_efficiency
+        if not np.any(allowed):
+            return None
+        dead = np.where(allowed, self.dead_fraction, np.inf)
+        candidates = np.flatnonzero(dead.ravel() == dead.min())
+        best = candidates[np.argmax(self.efficiency.ravel()[candidates])]
+        i, j = np.unravel_index(best, dead.shape)
+        return {
+            "argon_threshold": self.argon_thresholds[i],
+            "neutron_threshold": self.neutron_thresholds[j],
+            "efficiency": self.efficiency[i, j],
+            "dead_fraction": self.dead_fraction[i, j],
+        }
+
+    def roc(self):
+        """Pareto front of the surface: for every reachable dead fraction the best efficiency, as DataFrame"""
+        df = self.to_dataframe().sort_values(["dead_fraction", "efficiency"], ascending=[True, False])
+        front = df["efficiency"].to_numpy() > np.maximum.accumulate(
+            np.concatenate([[-np.inf], df["efficiency"].to_numpy()[:-1]]))
+        return df[front].reset_index(drop=True)
+
+    def to_dataframe(self):
+        """One row per threshold pair"""
+        argon, neutron = np.meshgrid(self.argon_thresholds, self.neutron_thresholds, indexing="ij")
+        return pd.DataFrame({
+            "argon_threshold": argon.ravel(),
+            "neutron_threshold": neutron.ravel(),
+            "efficiency": self.efficiency.ravel(),
+            "dead_fraction": self.dead_fraction.ravel(),
+        })
+
+    def __repr__(self):
+        return (f"VetoSurface({len(self.argon_thresholds)} x {len(self.neutron_thresholds)} thresholds, "
+                f"logic={self.logic})")
+
+
+def veto_surface(events, argon_thresholds, neutron_thresholds, argon_feature=ARGON_FEATURE,
+                 neutron_feature=NEUTRON_FEATURE, logic="or", weights=None):
+    """
+    Ge-77 tagging efficiency and fraction of vetoed other muons for every (argon, neutron) threshold pair.
+
+    events: EventTable (or anything with the feature columns and ge77_count).
+    weights: optional weight of every event, e.g. from combine_runs.
+    The events are histogrammed once by the index of the thresholds they pass, the counts for all
+    pairs follow from 2D cumulative sums of these histograms.
+    """
+    if logic not in ("or", "and"):
+        raise ValueError(f"Unknown veto logic {logic}, expected 'or' or 'and'.")
+    argon_thresholds = np.asarray(argon_thresholds, dtype=float)
+    neutron_thresholds = np.asarray(neutron_thresholds, dtype=float)
+    if np.any(np.diff(argon_thresholds) <= 0) or np.any(np.diff(neutron_thresholds) <= 0):
+        raise ValueError("The thresholds must be strictly increasing.")
+
+    is_ge77 = np.nan_to_num(np.asarray(events["ge77_count"], dtype=float), nan=0) > 0
+    weights = np.ones(len(is_ge77)) if weights is None else np.asarray(weights, dtype=float)
+    argon_index = threshold_index(events[argon_feature], argon_thresholds)
+    neutron_index = threshold_index(events[neutron_feature], neutron_thresholds)
+
+    n_argon, n_neutron = len(argon_thresholds), len(neutron_thresholds)
+    fractions = []
+    totals = []
+    for mask in (is_ge77, ~is_ge77):
+        above = vetoed_above(argon_index[mask], neutron_index[mask], weights[mask], n_argon, n_neutron)
+        both = above[1:, 1:]
+        if logic == "and":
+            vetoed = both
+        else:
+            vetoed = above[1:, :1] + above[:1, 1:] - both
+        total = above[0, 0]
+        totals.append(total)
+        fractions.append(vetoed / total if total > 0 else np.full(vetoed.shape, np.nan))
+
+    return VetoSurface(argon_thresholds, neutron_thresholds, fractions[0], fractions[1], totals[0], totals[1], logic)
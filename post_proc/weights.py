@@ -1,9 +1,10 @@
+import hashlib
 import json
 import os
 import numpy as np
 
-# These functions can be improved a lot. First make them read in the files once
-# Secondly this can probably be done in 1 or 2 functions instead of many similar ones.
+# The scalar functions below read the map files on every call. For anything more than
+# a handful of points use the OpticalMap class which reads them in once and works on arrays.
 
 MODERATOR_ACTUAL_R = 1720 # mm
 MODERATOR_ACTUAL_Z_TOP = 200 # mm this is the lower edge of the top Plate
@@ -360,4 +361,240 @@ def weight_edep_far_inside_z(z: float) -> tuple[float, float]:
     return (
         np.interp(adjusted_z, z_values, prob),
         np.interp(adjusted_z, z_values_xenon, prob_xenon),
-    )
\ No newline at end of file
+    )
+
+
+# zone name -> coordinate key used in the json file of that zone
+MAP_ZONES = {
+    "top_outside_r": "R",
+    "top_inside_r": "R",
+    "middle_r": "R",
+    "bottom_inside_r": "R",
+    "bottom_outside_r": "R",
+    "close_outside_z": "z",
+    "close_inside_z": "z",
+    "middle_inside_z": "z",
+    "far_inside_z": "z",
+}
+
+
+class OpticalMap:
+    """All 1d optical map zones (normal and xenon) loaded once into memory.
+
+    Same zone logic as get_weighted_energy, but evaluated with array masks on whole
+    radius/z arrays at once.
+    """
+
+    def __init__(self, map_dir: str = "./1d_map"):
+        self.map_dir = map_dir
+        self.zones = {}
+        for zone, coord in MAP_ZONES.items():
+            self.zones[zone] = (
+                self._load(f"{map_dir}/{zone}.json", coord),
+                self._load(f"{map_dir}/{zone}_xenon.json", coord),
+            )
+
+    @staticmethod
+    def _load(path: str, coord: str) -> tuple[np.ndarray, np.ndarray]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Required optical map file not found: {path}")
+        with open(path, "r") as f:
+            data = json.load(f)
+        return np.asarray(data[coord], dtype=float), np.asarray(data["prob"], dtype=float)
+
+    def _interp(self, zone: str, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        (x_normal, prob_normal), (x_xenon, prob_xenon) = self.zones[zone]
+        return np.interp(x, x_normal, prob_normal), np.interp(x, x_xenon, prob_xenon)
+
+    def get_weighted_energy(self, radius, z, strict: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """Get the (weight, weight_xenon) arrays for arrays of radius and z.
+           Expects the radius and z in mm. Gives the same values as calling
+           get_weighted_energy for every point.
+           With strict=False the z = 300 / z = -2900 boundary of the inside z zones
+           is evaluated instead of raising like the scalar functions do.
+           """
+        radius = np.asarray(radius, dtype=float)
+        z = np.asarray(z, dtype=float)
+        radius, z = np.broadcast_arrays(radius, z)
+
+        adjusted_radius = (radius + SHIFT_R) / 10 # convert mm to cm for map lookup and shift to map coords
+        adjusted_z = (z + SHIFT_Z) / 10
+
+        # Same branch order as get_weighted_energy, np.select takes the first matching condition
+        outside = (z > 300) | (radius > 1820) | (z < -2900)
+        inside_z = (z >= ((radius - 1720) + 200)) | (z <= ((1720 - radius) - 2800))
+        conditions = [
+            outside & (radius <= 1820),
+            outside & (z > 400),
+            outside & (z > 0),
+            outside & (z > -2600),
+            outside & (z > -3000),
+            outside,
+            inside_z & (radius < 1281),
+            inside_z & (radius <= 1520),
+            inside_z,
+            z > 0,
+            z > -2600,
+        ]
+        choices = [
+            ("close_outside_z", adjusted_z),
+            ("top_outside_r", adjusted_radius),
+            ("top_inside_r", adjusted_radius),
+            ("middle_r", adjusted_radius),
+            ("bottom_inside_r", adjusted_radius),
+            ("bottom_outside_r", adjusted_radius),
+            ("far_inside_z", adjusted_z),
+            ("middle_inside_z", adjusted_z),
+            ("close_inside_z", adjusted_z),
+            ("top_inside_r", adjusted_radius),
+            ("middle_r", adjusted_radius),
+        ]
+        default = ("bottom_inside_r", adjusted_radius)
+
+        zone_index = np.select(conditions, np.arange(len(conditions)), default=len(conditions))
+
+        # the scalar inside z-zone functions reject the z = 300 / z = -2900 boundary
+        bad_z = (zone_index >= 6) & (zone_index <= 8) & ~((-2900 < z) & (z < 300))
+        if strict and np.any(bad_z):
+            raise ValueError("Z must be < 300 mm or > -2900 mm for the inside z zones.")
+
+        weight = np.empty(radius.shape, dtype=float)
+        weight_xenon = np.empty(radius.shape, dtype=float)
+        for i, (zone, x) in enumerate(choices + [default]):
+            mask = zone_index == i
+            if not np.any(mask):
+                continue
+            weight[mask], weight_xenon[mask] = self._interp(zone, x[mask])
+
+        return weight, weight_xenon
+
+    def source_files(self) -> list[str]:
+        """Paths of all json files this map was loaded from."""
+        return self.source_files_in(self.map_dir)
+
+    @staticmethod
+    def source_files_in(map_dir: str) -> list[str]:
+        """Paths of all json files an OpticalMap reads from map_dir."""
+        return [
+            f"{map_dir}/{zone}{suffix}.json"
+            for zone in MAP_ZONES
+            for suffix in ("", "_xenon")
+        ]
+
+    def version(self) -> str:
+        """Hash of the json file mtimes and SHIFT_R/SHIFT_Z, changes whenever the weights can change."""
+        key_data = {
+            "mtimes": [os.path.getmtime(path) for path in self.source_files()],
+            "shift_r": SHIFT_R,
+            "shift_z": SHIFT_Z,
+        }
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()[:16]
+
+    def rasterize(
+        self,
+        dr: float = 5.0,
+        dz: float = 5.0,
+        r_max: float = 3500.0,
+        z_min: float = -4000.0,
+        z_max: float = 1500.0,
+        cache_dir: str | None = None,
+    ) -> "RasterOpticalMap":
+        """Bake the zone map into a regular (r, z) grid with spacing dr, dz in mm.
+
+        If cache_dir is given the grid is stored there as .npz, keyed on the mtimes of
+        the json files, SHIFT_R/SHIFT_Z and the grid parameters, and reused on the next call.
+        """
+        key_data = {"map": self.version(), "grid": [dr, dz, r_max, z_min, z_max]}
+        key = hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()[:16]
+        cache_path = None if cache_dir is None else os.path.join(cache_dir, f"optical_raster_{key}.npz")
+
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                raster = RasterOpticalMap(
+                    0.0, dr, z_min, dz,
+                    cached["weight"], cached["weight_xenon"],
+                    tuple(cached["max_deviation"]), exact=self,
+                )
+        else:
+            r_nodes = np.arange(int(np.ceil(r_max / dr)) + 1) * dr
+            z_nodes = z_min + np.arange(int(np.ceil((z_max - z_min) / dz)) + 1) * dz
+            rr, zz = np.meshgrid(r_nodes, z_nodes, indexing="ij")
+            weight, weight_xenon = self.get_weighted_energy(rr, zz, strict=False)
+
+            raster = RasterOpticalMap(0.0, dr, z_min, dz, weight, weight_xenon, (np.nan, np.nan), exact=self)
+
+            # compare against the exact map at the cell centres, the worst place for bilinear interpolation
+            r_mid, z_mid = np.meshgrid(r_nodes[:-1] + dr / 2, z_nodes[:-1] + dz / 2, indexing="ij")
+            exact_weight, exact_weight_xenon = self.get_weighted_energy(r_mid, z_mid, strict=False)
+            raster_weight, raster_weight_xenon = raster.get_weighted_energy(r_mid, z_mid)
+            raster.max_deviation = (
+                float(np.nanmax(np.abs(raster_weight - exact_weight))),
+                float(np.nanmax(np.abs(raster_weight_xenon - exact_weight_xenon))),
+            )
+
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.savez(cache_path, weight=weight, weight_xenon=weight_xenon,
+                         max_deviation=np.asarray(raster.max_deviation))
+
+        raster.key = key
+        print(f"Optical map raster ({dr} mm x {dz} mm): max deviation from exact map "
+              f"{raster.max_deviation[0]:.4g} (normal), {raster.max_deviation[1]:.4g} (xenon)")
+        return raster
+
+
+class RasterOpticalMap:
+    """Optical map weights on a regular (r, z) grid, looked up with bilinear interpolation.
+
+    Build it with OpticalMap.rasterize. Points outside the grid are passed on to the exact map.
+    max_deviation holds the largest (normal, xenon) difference to the exact map at the grid cell centres.
+    """
+
+    def __init__(self, r0, dr, z0, dz, weight, weight_xenon, max_deviation, exact=None):
+        self.r0 = r0
+        self.dr = dr
+        self.z0 = z0
+        self.dz = dz
+        self.weight = weight
+        self.weight_xenon = weight_xenon
+        self.max_deviation = max_deviation
+        self.exact = exact
+        self.key = None
+
+    def version(self) -> str:
+        """Hash of the exact map version and the grid parameters, see OpticalMap.version"""
+        return f"raster_{self.key}"
+
+    def get_weighted_energy(self, radius, z) -> tuple[np.ndarray, np.ndarray]:
+        """Get the (weight, weight_xenon) arrays for arrays of radius and z in mm."""
+        radius = np.asarray(radius, dtype=float)
+        z = np.asarray(z, dtype=float)
+        radius, z = np.broadcast_arrays(radius, z)
+
+        n_r, n_z = self.weight.shape
+        fr = (radius - self.r0) / self.dr
+        fz = (z - self.z0) / self.dz
+        in_grid = (fr >= 0) & (fr <= n_r - 1) & (fz >= 0) & (fz <= n_z - 1)
+
+        # index of the lower grid node, the last cell is reused for points on the upper edge
+        i = np.clip(np.floor(np.where(in_grid, fr, 0)).astype(np.int64), 0, n_r - 2)
+        j = np.clip(np.floor(np.where(in_grid, fz, 0)).astype(np.int64), 0, n_z - 2)
+        tr = np.where(in_grid, fr - i, 0.0)
+        tz = np.where(in_grid, fz - j, 0.0)
+
+        k = i * n_z + j
+        results = []
+        for grid in (self.weight.ravel(), self.weight_xenon.ravel()):
+            results.append(
+                (np.take(grid, k) * (1 - tz) + np.take(grid, k + 1) * tz) * (1 - tr)
+                + (np.take(grid, k + n_z) * (1 - tz) + np.take(grid, k + n_z + 1) * tz) * tr
+            )
+        weight, weight_xenon = results
+
+        if not np.all(in_grid):
+            if self.exact is None:
+                raise ValueError("Points outside the raster grid and no exact optical map to fall back to.")
+            outside = ~in_grid
+            weight[outside], weight_xenon[outside] = self.exact.get_weighted_energy(radius[outside], z[outside])
+
+        return weight, weight_xenon